@@ -5,10 +5,22 @@ Conversación: mistral-large-2411 | Visión: gemini-2.5-flash-lite | BD: Supabas
 """
 
 import os
-import json
+import hashlib
+import orjson
+from collections import deque
+from itertools import islice
+from io import BytesIO
+import asyncio
 import logging
+import re
+import time
+import uuid
+from contextlib import asynccontextmanager
 import traceback
 import httpx
+import requests
+from functools import lru_cache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 from datetime import datetime, date, timedelta, timezone
 from dotenv import load_dotenv
 
@@ -17,9 +29,10 @@ from fastapi.responses import PlainTextResponse
 import uvicorn
 
 from mistralai import Mistral
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 from google import genai
 from google.genai import types as genai_types
+from PIL import Image, ImageOps
 
 load_dotenv()
 
@@ -39,11 +52,67 @@ SUPABASE_URL             = os.environ["SUPABASE_URL"]
 SUPABASE_KEY             = os.environ["SUPABASE_KEY"]
 GEMINI_API_KEY           = os.environ["GEMINI_API_KEY"]
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Pool HTTP/2 con keep-alive para PostgREST, dimensionado para las consultas que corren
+# en paralelo desde los hilos de ejecutar_bd. `retries` solo reintenta fallas de conexión.
+SUPABASE_HTTP = httpx.Client(
+    timeout=15.0,
+    follow_redirects=True,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=1,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    ),
+)
+supabase: Client = create_client(
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    options=ClientOptions(httpx_client=SUPABASE_HTTP),
+)
 mistral = Mistral(api_key=MISTRAL_API_KEY)
-gemini = genai.Client(api_key=GEMINI_API_KEY)
+# google-genai manda las requests sin timeout si no se le pasa uno (en milisegundos)
+GEMINI_TIMEOUT_MS = 30_000
+gemini = genai.Client(api_key=GEMINI_API_KEY, http_options={"timeout": GEMINI_TIMEOUT_MS})
+
+# ── Límite de concurrencia y reintentos LLM ───
+# Una ráfaga de mensajes/fotos no debe disparar llamadas ilimitadas en paralelo: se
+# topean por proveedor y los 429/5xx o fallas de red se reintentan con backoff.
+LLM_CONCURRENCIA = int(os.environ.get("LLM_CONCURRENCIA", "8"))
+_sem_mistral = asyncio.Semaphore(LLM_CONCURRENCIA)
+_sem_gemini = asyncio.Semaphore(LLM_CONCURRENCIA)
+
+def _error_reintentable(exc: BaseException) -> bool:
+    # mistralai expone status_code; google-genai, code
+    codigo = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    if isinstance(codigo, int) and (codigo == 429 or codigo >= 500):
+        return True
+    # google-genai 1.2.0 hace las llamadas aio con requests (en un thread), no con httpx
+    return isinstance(exc, (
+        httpx.TransportError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        ConnectionError,
+        TimeoutError,
+    ))
+
+_reintentar_llm = retry(
+    retry=retry_if_exception(_error_reintentable),
+    wait=wait_exponential(multiplier=1, min=1, max=30),
+    stop=stop_after_attempt(3),
+    before_sleep=lambda estado: logger.warning(
+        f"Reintentando llamada LLM ({estado.attempt_number}/3): {estado.outcome.exception()}"
+    ),
+    reraise=True,
+)
+
+@_reintentar_llm
+async def mistral_chat(**kwargs):
+    async with _sem_mistral:
+        return await mistral.chat.complete_async(**kwargs)
 
-app = FastAPI()
+@_reintentar_llm
+async def gemini_generar(**kwargs):
+    async with _sem_gemini:
+        return await gemini.aio.models.generate_content(**kwargs)
 
 # ── Deduplicación de webhooks ─────────────────
 # Meta puede enviar el mismo evento varias veces. Guardamos los IDs ya procesados
@@ -79,23 +148,44 @@ CANCHAS = {
     3: "Cancha 3 - Interior cemento",
     4: "Cancha 4 - Exterior blindex y cesped",
 }
-
-def generar_horarios():
-    slots = []
-    m = 8 * 60
-    while m <= 22 * 60 + 30:  # Ultimo turno: 22:30
-        slots.append(f"{m // 60:02d}:{m % 60:02d}")
-        m += 90
-    return slots
-
-HORARIOS = generar_horarios()
+# Nombres indexados por cancha_id (ids chicos y consecutivos) para armar los mensajes
+NOMBRE_CANCHA: tuple[str, ...] = tuple(CANCHAS.get(i, "") for i in range(max(CANCHAS) + 1))
+
+# Turnos estándar de 90 minutos. Ningún turno puede empezar después de las 22:30;
+# el club también carga turnos manuales en horarios fuera de esta lista.
+PRIMER_TURNO_MIN = 8 * 60
+ULTIMO_TURNO_MIN = 22 * 60 + 30
+HORARIOS: tuple[str, ...] = tuple(
+    f"{m // 60:02d}:{m % 60:02d}" for m in range(PRIMER_TURNO_MIN, ULTIMO_TURNO_MIN + 1, 90)
+)
+HORARIOS_SET = frozenset(HORARIOS)
 
 SENA_MONTO         = 10000
 SENA_DESTINATARIO  = "Alejandro Santillan"
 ADMIN_WA_NUMBER    = os.environ.get("ADMIN_WA_NUMBER", "5492983448712")
 
+def formatear_monto(monto: int) -> str:
+    """10000 -> '10.000' (separador de miles argentino)."""
+    return f"{monto:,}".replace(",", ".")
+
+# Montos de seña ya formateados para 1..20 reservas
+MONTO_FMT = {n: formatear_monto(n * SENA_MONTO) for n in range(1, 21)}
+
+def monto_senas_fmt(cantidad: int) -> str:
+    """Monto total de `cantidad` señas, formateado."""
+    fmt = MONTO_FMT.get(cantidad)
+    return fmt if fmt is not None else formatear_monto(cantidad * SENA_MONTO)
+
 TIMEOUT_ESPERA_MINUTOS = 60
 
+# Tope de mensajes guardados por sesión. Antes de que un turno pueda llenarlo, los
+# más viejos se resumen en un único mensaje para no perder el contexto.
+MAX_HISTORIAL = 20
+HISTORIAL_A_RESUMIR = 10
+# Lo máximo que agrega un turno: usuario + ACCION + resultado + segunda ACCION +
+# resultado + respuesta final
+MENSAJES_POR_TURNO = 6
+
 def normalizar_telefono(telefono: str) -> str:
     """
     Normaliza un número de teléfono argentino a 10 dígitos (sin prefijo país, sin 0, sin 15).
@@ -122,213 +212,371 @@ def normalizar_telefono(telefono: str) -> str:
 
 # ── Supabase: reservas ────────────────────────
 
-def reservas_del_dia(fecha: str) -> list:
+async def ejecutar_bd(consulta):
+    """
+    Ejecuta una consulta de supabase-py en un hilo aparte.
+    El cliente de Supabase es síncrono; así no bloquea el event loop de FastAPI.
+    """
+    return await asyncio.to_thread(consulta.execute)
+
+# Columnas que realmente usa cada consulta (evita traer numero_operacion, creada_en, etc.)
+COLS_GRILLA = "id,cancha_id,hora,estado,nombre_cliente"
+COLS_LISTADO = "id,fecha,hora,cancha_id,nombre_cliente"
+# Para cancelar además hace falta el dueño y el estado
+COLS_CANCELACION = "id,fecha,hora,cancha_id,nombre_cliente,estado,telefono_cliente"
+
+async def reservas_del_dia(fecha: str) -> list:
     try:
-        return supabase.table("reservas").select("*").eq("fecha", fecha).execute().data or []
+        resp = await ejecutar_bd(supabase.table("reservas").select(COLS_GRILLA).eq("fecha", fecha))
+        return resp.data or []
     except Exception as e:
         logger.error(f"Error BD reservas_del_dia: {e}")
         return []
 
+# Exactamente "HH:MM": la hora se guarda tal cual en reservas.hora y se compara y ordena
+# como texto, así que "8:00" o " 9:00" no pueden pasar
+_HHMM_RE = re.compile(r"\d\d:\d\d", re.ASCII)
+
+@lru_cache(maxsize=128)
+def _parse_hhmm(hora: str) -> tuple[int, int]:
+    """
+    Parsea "HH:MM" a (hora, minuto). Mucho más barato que datetime.strptime para
+    un formato fijo; como los horarios se repiten, se cachea el resultado.
+    """
+    if not _HHMM_RE.fullmatch(hora):
+        raise ValueError(f"Hora con formato inválido: {hora!r}")
+    h, m = int(hora[:2]), int(hora[3:])
+    if not (0 <= h < 24 and 0 <= m < 60):
+        raise ValueError(f"Hora fuera de rango: {hora!r}")
+    return h, m
+
+def minutos_del_dia(hora: str) -> int:
+    h, m = _parse_hhmm(hora)
+    return h * 60 + m
+
+def hora_valida(hora) -> bool:
+    """True si `hora` es un turno estándar o un "HH:MM" entre el primer y el último inicio posible."""
+    if hora in HORARIOS_SET:
+        return True
+    try:
+        return PRIMER_TURNO_MIN <= minutos_del_dia(hora) <= ULTIMO_TURNO_MIN
+    except (ValueError, AttributeError, TypeError):
+        return False
+
+def mensaje_hora_invalida(hora) -> str:
+    return (
+        f"HORA_INVALIDA: {hora} no es un horario válido. "
+        "Los turnos empiezan entre las 08:00 y las 22:30 (formato HH:MM)."
+    )
+
+def turno_ya_paso(hora: str, ahora: datetime) -> bool:
+    """True si el turno de hoy a `hora` ya empezó según `ahora` (hora Argentina)."""
+    h, m = _parse_hhmm(hora)
+    return ahora.replace(hour=h, minute=m, second=0, microsecond=0) <= ahora
+
 def hay_solapamiento(hora_nueva: str, hora_existente: str, duracion_min: int = 90) -> bool:
     """
     Devuelve True si dos turnos de `duracion_min` minutos se superponen.
     Un turno ocupa [inicio, inicio + duracion_min). Dos rangos se solapan si
     inicio_A < fin_B  y  inicio_B < fin_A.
     """
-    fmt = "%H:%M"
-    ini_a = datetime.strptime(hora_nueva, fmt)
-    fin_a = ini_a + timedelta(minutes=duracion_min)
-    ini_b = datetime.strptime(hora_existente, fmt)
-    fin_b = ini_b + timedelta(minutes=duracion_min)
-    return ini_a < fin_b and ini_b < fin_a
-
-def canchas_libres(fecha: str, hora: str, duracion_min: int = 90) -> list:
+    ini_a = minutos_del_dia(hora_nueva)
+    ini_b = minutos_del_dia(hora_existente)
+    return ini_a < ini_b + duracion_min and ini_b < ini_a + duracion_min
+
+async def canchas_libres_turnos(turnos: list, duracion_min: int = 90) -> list:
     """
-    Devuelve las canchas sin reservas que se solapen con el turno solicitado.
-    Detecta conflictos aunque el turno existente tenga un horario no estándar.
+    Devuelve, para cada turno (fecha, hora) de `turnos`, la lista de canchas sin reservas
+    que se solapen con él. Todo se resuelve en una sola llamada a la RPC canchas_libres
+    (el solapamiento se calcula en Postgres), así que también detecta conflictos con
+    turnos existentes de horario no estándar.
     """
-    ocupadas = {
-        r["cancha_id"]
-        for r in reservas_del_dia(fecha)
-        if r.get("estado") != "cancelada"
-        and hay_solapamiento(hora, r["hora"], duracion_min)
-    }
-    return [c for c in CANCHAS if c not in ocupadas]
-
-def crear_reserva(fecha, hora, cancha_id, nombre, telefono, numero_operacion=None):
+    if not turnos:
+        return []
     try:
+        resp = await ejecutar_bd(
+            supabase.rpc(
+                "canchas_libres",
+                {
+                    "p_fechas": [fecha for fecha, _ in turnos],
+                    "p_horas": [hora for _, hora in turnos],
+                    "p_canchas": list(CANCHAS),
+                    "p_duracion": duracion_min,
+                },
+            )
+        )
+        libres = [[] for _ in turnos]
+        for fila in resp.data or []:
+            libres[fila["orden"] - 1] = fila["libres"]
+        return libres
+    except Exception as e:
+        logger.error(f"Error BD canchas_libres: {e}")
+        return [list(CANCHAS) for _ in turnos]
+
+async def canchas_libres(fecha: str, hora: str, duracion_min: int = 90) -> list:
+    return (await canchas_libres_turnos([(fecha, hora)], duracion_min))[0]
+
+async def crear_reservas(reservas: list, numero_operacion=None):
+    """
+    Inserta reservas confirmadas (dicts con fecha, hora, cancha_id, nombre, telefono)
+    en un único INSERT multi-fila: una sola transacción, o entran todas o ninguna.
+    Retorna la lista de filas creadas, "DUPLICADO" si la BD rechaza alguna por turno ya
+    tomado o por número de operación usado en otro lote (reservas_numero_operacion_excl),
+    o None ante cualquier otro error.
+    Las reservas pagadas con un mismo comprobante comparten `lote_id`.
+    """
+    creada_en = ahora_arg().isoformat()
+    lote_id = str(uuid.uuid4())
+    filas = []
+    for r in reservas:
         data = {
-            "fecha": fecha,
-            "hora": hora,
-            "cancha_id": cancha_id,
-            "nombre_cliente": nombre,
-            "telefono_cliente": telefono,
+            "fecha": r["fecha"],
+            "hora": r["hora"],
+            "cancha_id": r["cancha_id"],
+            "nombre_cliente": r["nombre"],
+            "telefono_cliente": r["telefono"],
             "estado": "confirmada",
-            "creada_en": ahora_arg().isoformat(),
+            "creada_en": creada_en,
+            "lote_id": lote_id,
         }
         if numero_operacion:
             data["numero_operacion"] = numero_operacion
-        resp = supabase.table("reservas").insert(data).execute()
-        return resp.data[0] if resp.data else None
+        filas.append(data)
+    try:
+        resp = await ejecutar_bd(supabase.table("reservas").insert(filas))
+        return resp.data or None
     except Exception as e:
-        logger.error(f"Error creando reserva: {e}")
-        if "23505" in str(e):
+        logger.error(f"Error creando reservas: {e}")
+        if "23505" in str(e) or "23P01" in str(e):
             return "DUPLICADO"
         return None
 
-def reservas_por_telefono(telefono: str) -> list:
+async def reservas_por_telefono(telefono: str) -> list:
     try:
-        return (
+        resp = await ejecutar_bd(
             supabase.table("reservas")
-            .select("*")
+            .select(COLS_LISTADO)
             .eq("telefono_cliente", telefono)
             .neq("estado", "cancelada")
             .gte("fecha", hoy_argentina())
             .order("fecha")
-            .execute()
-            .data or []
         )
+        return resp.data or []
     except Exception as e:
         logger.error(f"Error reservas_por_telefono: {e}")
         return []
 
-def reserva_por_id(rid: int):
+async def reserva_por_id(rid: int):
     try:
-        data = supabase.table("reservas").select("*").eq("id", rid).execute().data
-        return data[0] if data else None
+        resp = await ejecutar_bd(supabase.table("reservas").select(COLS_CANCELACION).eq("id", rid))
+        return resp.data[0] if resp.data else None
     except Exception:
         return None
 
-def cancelar_reserva_bd(rid: int) -> bool:
+async def cancelar_reserva_bd(rid: int) -> bool:
     try:
-        supabase.table("reservas").update({"estado": "cancelada"}).eq("id", rid).execute()
+        await ejecutar_bd(supabase.table("reservas").update({"estado": "cancelada"}).eq("id", rid))
         return True
     except Exception as e:
         logger.error(f"Error cancelando reserva: {e}")
         return False
 
-def operacion_ya_usada(numero_operacion: str) -> bool:
+async def reservas_por_ids(ids: list):
+    """Trae varias reservas en una sola consulta. Retorna {id: reserva} o None si falla la BD."""
     try:
-        data = (
+        resp = await ejecutar_bd(supabase.table("reservas").select(COLS_CANCELACION).in_("id", ids))
+        return {r["id"]: r for r in resp.data or []}
+    except Exception as e:
+        logger.error(f"Error reservas_por_ids: {e}")
+        return None
+
+async def cancelar_reservas_bd(ids: list) -> bool:
+    """Cancela varias reservas con un único UPDATE."""
+    try:
+        await ejecutar_bd(
             supabase.table("reservas")
-            .select("id")
-            .eq("numero_operacion", numero_operacion)
+            .update({"estado": "cancelada"})
+            .in_("id", ids)
             .neq("estado", "cancelada")
-            .execute()
-            .data
         )
-        return len(data) > 0
+        return True
     except Exception as e:
-        logger.error(f"Error verificando operacion: {e}")
+        logger.error(f"Error cancelando reservas {ids}: {e}")
         return False
 
-def grilla_texto(fecha: str) -> str:
-    reservas = [r for r in reservas_del_dia(fecha) if r.get("estado") != "cancelada"]
+GRILLA_ENCABEZADO = f"{'Hora':<7}|{'C1':<7}|{'C2':<7}|{'C3':<7}|{'C4':<7}"
+GRILLA_SEPARADOR = "-" * 37
+CELDA_LIBRE = f"{'libre':<7}"
+CELDA_SOLAPADA = f"{'[sol]':<7}"
+
+async def grilla_texto(fecha: str) -> str:
+    reservas = [r for r in await reservas_del_dia(fecha) if r.get("estado") != "cancelada"]
     # Unión de horarios estándar + horas reales en BD (para capturar turnos manuales)
     horas_en_bd = {r["hora"] for r in reservas}
-    horas_mostrar = sorted(set(HORARIOS) | horas_en_bd)
-    idx = {(r["cancha_id"], r["hora"]): r for r in reservas}
-    txt = f"Grilla {fecha}:\n"
-    txt += f"{'Hora':<7}|{'C1':<7}|{'C2':<7}|{'C3':<7}|{'C4':<7}\n"
-    txt += "-" * 37 + "\n"
-    for hora in horas_mostrar:
-        fila = f"{hora:<7}|"
-        for cid in range(1, 5):
-            r = idx.get((cid, hora))
-            if r:
-                partes = r["nombre_cliente"].split()
-                ini = "".join(p[0].upper() for p in partes[:2])
-                fila += f"{ini:<7}|"
-            else:
+    horas_mostrar = sorted(HORARIOS_SET | horas_en_bd)
+    # Grilla densa filas=horas x columnas=canchas, indexada por posición
+    hora_idx = {h: i for i, h in enumerate(horas_mostrar)}
+    grid = [[None] * len(CANCHAS) for _ in horas_mostrar]
+    horas_por_cancha = [[] for _ in CANCHAS]
+    for r in reservas:
+        # Una cancha desconocida no tiene columna: se ignora, como antes
+        if r["cancha_id"] not in CANCHAS:
+            continue
+        col = r["cancha_id"] - 1
+        grid[hora_idx[r["hora"]]][col] = "".join(p[0].upper() for p in r["nombre_cliente"].split()[:2]).ljust(7)
+        horas_por_cancha[col].append(r["hora"])
+    lineas = [f"Grilla {fecha}:", GRILLA_ENCABEZADO, GRILLA_SEPARADOR]
+    for hora, fila in zip(horas_mostrar, grid):
+        for col, celda in enumerate(fila):
+            if celda is None:
                 # Marcar [sol] si esta franja horaria se superpone con una reserva existente en esa cancha
-                ocupada = any(
-                    hay_solapamiento(hora, r2["hora"])
-                    for r2 in reservas
-                    if r2["cancha_id"] == cid
-                )
-                fila += f"{'[sol]':<7}|" if ocupada else f"{'libre':<7}|"
-        txt += fila + "\n"
-    return txt
+                ocupada = any(hay_solapamiento(hora, h2) for h2 in horas_por_cancha[col])
+                fila[col] = CELDA_SOLAPADA if ocupada else CELDA_LIBRE
+        lineas.append(f"{hora:<7}|" + "|".join(fila) + "|")
+    return "\n".join(lineas) + "\n"
 
 # ── Supabase: sesiones ────────────────────────
 # El campo en BD se llama telegram_user_id pero se usa con wa_id (string).
 # No se renombra la columna — compatible con Supabase jsonb/text.
 
-def sesion_get(wa_id: str) -> dict:
+async def sesion_get(wa_id: str) -> dict:
+    """
+    Lee la sesión vía la RPC get_or_expire_session, que en la misma transacción
+    resetea la espera del comprobante si pasaron más de TIMEOUT_ESPERA_MINUTOS.
+    """
     defaults = {
         "esperando_comprobante": False,
         "reserva_pendiente": None,
         "telefono_confirmado": None,
         "nombre_confirmado": None,
         "esperando_desde": None,
-        "historial": [],
+        "historial": deque(maxlen=MAX_HISTORIAL),
     }
     try:
-        data = (
-            supabase.table("sesiones_bot")
-            .select("*")
-            .eq("telegram_user_id", wa_id)
-            .execute()
-            .data
+        resp = await ejecutar_bd(
+            supabase.rpc(
+                "get_or_expire_session",
+                {"wa": wa_id, "timeout_min": TIMEOUT_ESPERA_MINUTOS},
+            )
         )
+        data = resp.data
         if data:
             s = data[0]
-            sesion = {
+            return {
                 "esperando_comprobante": s.get("esperando_comprobante", False),
                 "reserva_pendiente": s.get("reserva_pendiente"),
                 "telefono_confirmado": s.get("telefono_confirmado"),
                 "nombre_confirmado": s.get("nombre_confirmado"),
                 "esperando_desde": s.get("esperando_desde"),
-                "historial": s.get("historial", []),
+                # deque con tope: los append descartan solos los mensajes más viejos
+                "historial": deque(s.get("historial") or [], maxlen=MAX_HISTORIAL),
             }
-            # Auto-resetear si la espera expiró
-            if sesion["esperando_comprobante"] and sesion["esperando_desde"]:
-                desde = datetime.fromisoformat(sesion["esperando_desde"])
-                if desde.tzinfo is None:
-                    desde = desde.replace(tzinfo=ZONA_ARG)
-                minutos_esperando = (ahora_arg() - desde).total_seconds() / 60
-                if minutos_esperando > TIMEOUT_ESPERA_MINUTOS:
-                    logger.info(
-                        f"Sesión expirada para {wa_id} ({minutos_esperando:.0f} min). Reseteando."
-                    )
-                    sesion["esperando_comprobante"] = False
-                    sesion["reserva_pendiente"] = None
-                    sesion["esperando_desde"] = None
-                    sesion_set(wa_id, sesion)
-            return sesion
     except Exception as e:
         logger.error(f"Error leyendo sesión: {e}")
     return defaults
 
-def sesion_set(wa_id: str, sesion: dict):
+def _campos_sesion(sesion: dict) -> dict:
+    """Columnas persistidas de la sesión (el historial como lista, para el JSON)."""
+    return {
+        "esperando_comprobante": sesion.get("esperando_comprobante", False),
+        "reserva_pendiente": sesion.get("reserva_pendiente"),
+        "telefono_confirmado": sesion.get("telefono_confirmado"),
+        "nombre_confirmado": sesion.get("nombre_confirmado"),
+        "historial": list(sesion.get("historial") or ()),
+        "esperando_desde": sesion.get("esperando_desde"),
+    }
+
+async def sesion_set(wa_id: str, sesion: dict, campos: list | None = None):
+    """
+    Guarda la sesión. Con `campos`, actualiza solo esas columnas (p. ej. sin reenviar el
+    historial si solo cambió un flag); si la fila todavía no existe, cae al upsert completo.
+    """
+    fila = _campos_sesion(sesion)
+    ahora = ahora_arg().isoformat()
     try:
-        supabase.table("sesiones_bot").upsert({
+        if campos is not None:
+            resp = await ejecutar_bd(
+                supabase.table("sesiones_bot")
+                .update({**{c: fila[c] for c in campos}, "actualizado_en": ahora})
+                .eq("telegram_user_id", wa_id)
+            )
+            if resp.data:
+                logger.info(f"sesion_set OK para {wa_id} | campos={campos}")
+                return
+        await ejecutar_bd(supabase.table("sesiones_bot").upsert({
             "telegram_user_id": wa_id,
-            "esperando_comprobante": sesion.get("esperando_comprobante", False),
-            "reserva_pendiente": sesion.get("reserva_pendiente"),
-            "telefono_confirmado": sesion.get("telefono_confirmado"),
-            "nombre_confirmado": sesion.get("nombre_confirmado"),
-            "historial": sesion.get("historial", []),
-            "esperando_desde": sesion.get("esperando_desde"),
-            "actualizado_en": ahora_arg().isoformat(),
-        }).execute()
+            **fila,
+            "actualizado_en": ahora,
+        }))
         logger.info(
             f"sesion_set OK para {wa_id} | esperando_comprobante={sesion.get('esperando_comprobante')}"
         )
     except Exception as e:
         logger.error(f"sesion_set FALLÓ para {wa_id}: {e}")
 
+class SesionCtx:
+    """
+    Lee la sesión una vez al entrar y la guarda una sola vez al salir, solo las columnas
+    que cambiaron. Si el handler falla a mitad de camino, llama a descartar() para no
+    persistir un estado a medio armar.
+
+        async with SesionCtx(wa_id) as ctx:
+            sesion = ctx.sesion
+    """
+
+    def __init__(self, wa_id: str):
+        self.wa_id = wa_id
+        self.sesion = None
+        self._inicial = None
+        self._descartada = False
+
+    @staticmethod
+    def _huella(sesion: dict) -> dict:
+        return {c: orjson.dumps(v) for c, v in _campos_sesion(sesion).items()}
+
+    async def __aenter__(self):
+        self.sesion = await sesion_get(self.wa_id)
+        self._inicial = self._huella(self.sesion)
+        return self
+
+    def descartar(self):
+        self._descartada = True
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None and not self._descartada:
+            actual = self._huella(self.sesion)
+            cambiados = [c for c, v in actual.items() if v != self._inicial[c]]
+            if cambiados:
+                await sesion_set(self.wa_id, self.sesion, cambiados)
+        return False
+
 # ── WhatsApp Cloud API ────────────────────────
 
 GRAPH_BASE = f"https://graph.facebook.com/{GRAPH_API_VERSION}"
 
-def enviar_mensaje_whatsapp(wa_id: str, texto: str):
+# Cliente HTTP compartido: reutiliza conexiones (keep-alive + HTTP/2) con Graph API
+# en lugar de abrir un TCP + TLS nuevo por cada mensaje o descarga. Las descargas de media
+# van a otro host (lookaside.fbsbx.com), que tiene su propio pool dentro del mismo cliente.
+# Las conexiones ociosas se mantienen 60 s (el default de httpx es 5 s), así los
+# comprobantes que llegan espaciados tampoco vuelven a pagar el handshake.
+WA_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=15.0,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=40, keepalive_expiry=60),
+    headers={"Authorization": f"Bearer {WHATSAPP_API_TOKEN}"},
+)
+
+# Envíos en segundo plano. asyncio solo guarda referencias débiles a las tareas,
+# por eso se mantienen en un set hasta que terminan. Además se recuerda la última
+# tarea de cada destinatario para que sus mensajes salgan en el orden en que se encolaron.
+_envios_pendientes: set[asyncio.Task] = set()
+_ultimo_envio: dict[str, asyncio.Task] = {}
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+async def enviar_mensaje_whatsapp(wa_id: str, texto: str):
     """Envía un mensaje de texto a un número de WhatsApp via Graph API."""
     url = f"{GRAPH_BASE}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
     payload = {
         "messaging_product": "whatsapp",
         "to": wa_id,
@@ -336,68 +584,78 @@ def enviar_mensaje_whatsapp(wa_id: str, texto: str):
         "text": {"body": texto},
     }
     try:
-        r = httpx.post(url, json=payload, headers=headers, timeout=15)
+        r = await WA_CLIENT.post(url, content=orjson.dumps(payload), headers=_JSON_HEADERS)
         r.raise_for_status()
     except Exception as e:
         logger.error(f"Error enviando mensaje WA a {wa_id}: {e}")
 
-def descargar_imagen_whatsapp(image_id: str) -> bytes | None:
+def programar_envio_whatsapp(wa_id: str, texto: str) -> asyncio.Task:
+    """
+    Envía el mensaje sin esperar la respuesta de Graph API, así el webhook no
+    queda bloqueado por el POST saliente. Respeta el orden por destinatario.
+    """
+    anterior = _ultimo_envio.get(wa_id)
+
+    async def _enviar():
+        if anterior is not None:
+            await asyncio.wait([anterior])
+        await enviar_mensaje_whatsapp(wa_id, texto)
+
+    tarea = asyncio.create_task(_enviar())
+    _envios_pendientes.add(tarea)
+    _ultimo_envio[wa_id] = tarea
+
+    def _limpiar(t: asyncio.Task):
+        _envios_pendientes.discard(t)
+        if _ultimo_envio.get(wa_id) is t:
+            del _ultimo_envio[wa_id]
+
+    tarea.add_done_callback(_limpiar)
+    return tarea
+
+async def descargar_imagen_whatsapp(image_id: str) -> bytes | None:
     """
     Descarga una imagen de WhatsApp en dos pasos:
     1. Obtiene la URL de descarga usando el image_id.
-    2. Descarga los bytes desde esa URL.
+    2. Descarga los bytes desde esa URL en streaming, en bloques de 64 KiB.
     """
-    headers = {"Authorization": f"Bearer {WHATSAPP_API_TOKEN}"}
     try:
         # Paso 1: resolver URL
-        meta_url = f"{GRAPH_BASE}/{image_id}"
-        r1 = httpx.get(meta_url, headers=headers, timeout=15)
+        r1 = await WA_CLIENT.get(f"{GRAPH_BASE}/{image_id}")
         r1.raise_for_status()
-        download_url = r1.json().get("url")
+        download_url = orjson.loads(r1.content).get("url")
         if not download_url:
             logger.error(f"No se obtuvo URL para image_id={image_id}")
             return None
         # Paso 2: descargar bytes
-        r2 = httpx.get(download_url, headers=headers, timeout=30)
-        r2.raise_for_status()
-        return r2.content
+        buf = bytearray()
+        async with WA_CLIENT.stream("GET", download_url, timeout=30) as r2:
+            r2.raise_for_status()
+            async for chunk in r2.aiter_bytes(65536):
+                buf.extend(chunk)
+        return bytes(buf)
     except Exception as e:
         logger.error(f"Error descargando imagen WA id={image_id}: {e}")
         return None
 
 # ── Verificación de comprobante (Gemini Flash visión) ──
 
-def verificar_comprobante(
-    imagen_bytes: bytes,
-    media_type: str = "image/jpeg",
-    monto_esperado: int = None,
-) -> dict:
-    """
-    Usa gemini-2.5-flash-lite para verificar si la imagen es un comprobante válido.
-    Retorna: {"valido": bool, "ilegible": bool, "motivo": str, "numero_operacion": str|null}
-    """
-    fecha_hoy = ahora_arg().strftime("%d/%m/%Y")
-    MESES_ES = ["enero", "febrero", "marzo", "abril", "mayo", "junio",
-                "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"]
-    ahora = ahora_arg()
-    # Solo fecha numérica — el nombre del día en el comprobante puede no coincidir
-    # con el día real y no es relevante para validar si el pago es de hoy.
-    fecha_hoy_larga = f"{ahora.day} de {MESES_ES[ahora.month - 1]} de {ahora.year}"
-    monto = monto_esperado if monto_esperado is not None else SENA_MONTO
-    monto_fmt = f"{monto:,}".replace(",", ".")
+MESES_ES = ("enero", "febrero", "marzo", "abril", "mayo", "junio",
+            "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre")
 
-    prompt = f"""Analizá esta imagen. Es un comprobante de transferencia bancaria enviado por un cliente para confirmar una reserva de pádel.
+# Prompt invariante; solo cambian fecha y monto. Las llaves del JSON van dobles por .format().
+PROMPT_COMPROBANTE = """Analizá esta imagen. Es un comprobante de transferencia bancaria enviado por un cliente para confirmar una reserva de pádel.
 
 Tu tarea es extraer la información visible y verificar si cumple los criterios. Leé con atención todo el texto de la imagen antes de responder.
 
 CRITERIOS A VERIFICAR (los tres deben cumplirse para que sea válido):
 1. TIPO: Debe ser un comprobante de transferencia bancaria. Puede ser de Mercado Pago, Naranja X, Brubank, BBVA, Galicia, Santander, Uala, o cualquier banco/billetera argentina.
-2. DESTINATARIO: El campo "Para", "Destinatario" o similar debe contener "{SENA_DESTINATARIO}". Aceptá variaciones como: "Roberto Alejandro Santillan", "Alejandro Santillan", "A. Santillan", con o sin tilde en la i. NO es necesario que sea exacto, solo que el apellido "Santillan" esté presente.
-3. MONTO: Debe ser exactamente ${monto_fmt} pesos. Puede aparecer como "${monto_fmt}", "$ {monto_fmt}", "{monto}" o similar.
+2. DESTINATARIO: El campo "Para", "Destinatario" o similar debe contener "{destinatario}". Aceptá variaciones como: "Roberto Alejandro Santillan", "Alejandro Santillan", "A. Santillan", con o sin tilde en la i. NO es necesario que sea exacto, solo que el apellido "Santillan" esté presente.
+3. MONTO: {criterio_monto}
 4. FECHA: Debe ser del día de hoy. Hoy es {fecha_hoy_larga} ({fecha_hoy}).
    - Ignorá el nombre del día de la semana que aparezca en el comprobante.
    - Verificá que el número de día y el mes coincidan con hoy.
-   - Para el año: aceptá tanto el formato completo ({ahora_arg().year}) como el formato corto ({str(ahora_arg().year)[2:]}). 
+   - Para el año: aceptá tanto el formato completo ({anio}) como el formato corto ({anio_corto}). 
    - Si el día y mes coinciden pero el año no aparece claramente o está en formato corto, considerá la fecha como válida.
    - Solo rechazá por fecha si el día o el mes claramente no coinciden con hoy.
 
@@ -407,12 +665,68 @@ Poné ilegible: true SOLO si la imagen está tan borrosa, oscura o recortada que
 NÚMERO DE OPERACIÓN: Buscá cualquier código o número único del pago (puede llamarse "Número de operación", "ID de transacción", "Código", "Referencia", "N° comprobante", etc.) y extraelo. En Mercado Pago suele aparecer al final como "Número de operación de Mercado Pago".
 
 Respondé ÚNICAMENTE con JSON válido, sin texto adicional ni backticks:
-{{"valido": true/false, "ilegible": true/false, "motivo": "explicación breve en español de qué cumple o qué falta", "numero_operacion": "el número encontrado o null"}}"""
+{{"valido": true/false, "ilegible": true/false, "motivo": "explicación breve en español de qué cumple o qué falta", "numero_operacion": "el número encontrado o null", "monto": el monto aceptado que coincide, como número entero sin puntos, o null}}"""
+
+@lru_cache(maxsize=32)
+def prompt_comprobante(hoy: date, montos: tuple[int, ...]) -> str:
+    """
+    Arma el prompt de verificación para un día y los montos aceptados.
+    Cacheado: todos los comprobantes del mismo día y montos usan exactamente el mismo string.
+    """
+    formas = [f'"${formatear_monto(m)}", "$ {formatear_monto(m)}", "{m}"' for m in montos]
+    if len(montos) == 1:
+        criterio_monto = (
+            f"Debe ser exactamente ${formatear_monto(montos[0])} pesos. "
+            f"Puede aparecer como {formas[0]} o similar."
+        )
+    else:
+        criterio_monto = (
+            "Debe ser exactamente uno de estos montos: "
+            + " o ".join(f"${formatear_monto(m)}" for m in montos)
+            + " pesos. Puede aparecer como " + "; ".join(formas) + " o similar. "
+            'Indicá en "monto" cuál de ellos coincide.'
+        )
+    # Solo fecha numérica — el nombre del día en el comprobante puede no coincidir
+    # con el día real y no es relevante para validar si el pago es de hoy.
+    return PROMPT_COMPROBANTE.format(
+        destinatario=SENA_DESTINATARIO,
+        criterio_monto=criterio_monto,
+        fecha_hoy_larga=f"{hoy.day} de {MESES_ES[hoy.month - 1]} de {hoy.year}",
+        fecha_hoy=hoy.strftime("%d/%m/%Y"),
+        anio=hoy.year,
+        anio_corto=str(hoy.year)[2:],
+    )
+
+
+def _monto_coincidente(valor, montos: tuple[int, ...]):
+    """Normaliza el "monto" que devolvió Gemini; None si no es uno de los aceptados."""
+    if len(montos) == 1:
+        return montos[0]
+    if isinstance(valor, (int, float)):
+        n = int(valor)
+    else:
+        digitos = re.sub(r"\D", "", re.sub(r",\d{1,2}$", "", str(valor or "")))
+        n = int(digitos) if digitos else None
+    return n if n in montos else None
+
+async def verificar_comprobante(
+    imagen_bytes: bytes,
+    media_type: str = "image/jpeg",
+    montos: tuple[int, ...] = (SENA_MONTO,),
+) -> dict:
+    """
+    Usa gemini-2.5-flash-lite para verificar si la imagen es un comprobante válido
+    por alguno de los `montos` aceptados, en una sola llamada.
+    Retorna: {"valido": bool, "ilegible": bool, "motivo": str, "numero_operacion": str|null,
+              "monto": int|None (el monto que coincidió)}
+    """
+    montos = tuple(montos)
+    prompt = prompt_comprobante(ahora_arg().date(), montos)
 
     texto = ""
     try:
         imagen_part = genai_types.Part.from_bytes(data=imagen_bytes, mime_type=media_type)
-        response = gemini.models.generate_content(
+        response = await gemini_generar(
             model="gemini-2.5-flash-lite",
             contents=[prompt, imagen_part],
         )
@@ -424,13 +738,13 @@ Respondé ÚNICAMENTE con JSON válido, sin texto adicional ni backticks:
             inicio = texto.index("{")
             fin = texto.rindex("}") + 1
             texto = texto[inicio:fin]
-        resultado = json.loads(texto)
+        resultado = orjson.loads(texto)
         logger.info(f"Gemini resultado crudo (intento 1): {resultado}")
         # Si el primer intento rechaza y la imagen no es ilegible, reintentar una vez
         if not resultado.get("valido") and not resultado.get("ilegible"):
             logger.info("Gemini rechazó el comprobante en intento 1. Reintentando...")
             try:
-                response2 = gemini.models.generate_content(
+                response2 = await gemini_generar(
                     model="gemini-2.5-flash-lite",
                     contents=[prompt, imagen_part],
                 )
@@ -440,14 +754,15 @@ Respondé ÚNICAMENTE con JSON válido, sin texto adicional ni backticks:
                     inicio2 = texto2.index("{")
                     fin2 = texto2.rindex("}") + 1
                     texto2 = texto2[inicio2:fin2]
-                resultado2 = json.loads(texto2)
+                resultado2 = orjson.loads(texto2)
                 logger.info(f"Gemini resultado crudo (intento 2): {resultado2}")
                 if resultado2.get("valido"):
-                    return resultado2
+                    resultado = resultado2
             except Exception as e2:
                 logger.error(f"Error en reintento Gemini: {e2}")
+        resultado["monto"] = _monto_coincidente(resultado.get("monto"), montos)
         return resultado
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"Gemini devolvió JSON inválido: {e} | Respuesta: {texto!r}")
         return {
             "valido": False,
@@ -466,21 +781,12 @@ Respondé ÚNICAMENTE con JSON válido, sin texto adicional ni backticks:
 
 # ── Mistral conversacional ────────────────────
 
-def build_system(hoy: str, telefono_conocido: str = None, nombre_conocido: str = None) -> str:
-    horarios_str = ", ".join(HORARIOS)
-    contexto_telefono = ""
-    if telefono_conocido and nombre_conocido:
-        contexto_telefono = (
-            f"\nDATOS DEL USUARIO: Su nombre es {nombre_conocido} y su telefono confirmado es {telefono_conocido}. "
-            f"Si la reserva es a nombre de {nombre_conocido}, usá ese telefono directamente sin pedirlo. "
-            "Si la reserva es a nombre de OTRA persona, pedí el telefono de esa persona explicitamente, no uses el guardado."
-        )
-    elif telefono_conocido:
-        contexto_telefono = (
-            f"\nDATOS DEL USUARIO: Su telefono confirmado es {telefono_conocido}. "
-            "Usalo solo si la reserva es para el mismo usuario; si es para otra persona, pedí su telefono."
-        )
-    return f"""Sos el asistente virtual del club de padel "Los Ciruelos Padel" en Argentina.
+# Parte invariante del system prompt: se arma una sola vez al importar. Todo lo que
+# depende del turno (fecha, hora, datos del usuario) va al final, así el prefijo es
+# idéntico en cada llamada y el proveedor puede reutilizar su caché de prompt.
+HORARIOS_STR = ", ".join(HORARIOS)
+
+SYSTEM_STATIC = f"""Sos el asistente virtual del club de padel "Los Ciruelos Padel" en Argentina.
 Hablas en espanol rioplatense (vos, tenes, etc.) de forma amigable y natural.
 
 IDENTIDAD:
@@ -491,8 +797,8 @@ INFORMACION DEL CLUB:
 - Direccion: Calle 34 num. 1527 e/ 25 y 26, La Plata
 - 4 canchas: Canchas 1, 2 y 3 son interiores de cemento. Cancha 4 es exterior con blindex y cesped.
 - Horarios: 08:00 a 00:00, turnos de 1.5 horas. El ultimo turno disponible es a las 22:30 (termina a las 00:00). No ofrecer ni aceptar turnos con inicio despues de las 22:30.
-- Turnos estandar: {horarios_str} (son referencia orientativa — el sistema también acepta horarios fuera de esta lista si fueron asignados manualmente por el club)
-- Si el usuario pide un horario no estandar entre 08:00 y 22:30, usalo tal cual en la accion sin aproximarlo a uno estandar
+- Turnos estandar: {HORARIOS_STR} (son referencia orientativa — el sistema también acepta horarios fuera de esta lista si fueron asignados manualmente por el club)
+- Si el usuario pide un horario no estandar entre 08:00 y 22:30, usalo tal cual al llamar a la función sin aproximarlo a uno estandar
 - Precio del turno: $36.000 (1.5 horas)
 - Alquiler de paletas: $4.000 por turno (disponibles en el club)
 - Equipamiento: el club vende equipamiento general de padel (paletas, pelotas, indumentaria)
@@ -500,8 +806,6 @@ INFORMACION DEL CLUB:
 - Instalaciones: buffet y vestuarios disponibles en el club
 - Cancha 4 exterior: en caso de lluvia, contactar al administrador al WhatsApp +{ADMIN_WA_NUMBER} para verificar condiciones
 - Socios: para asociarse al club contactar al administrador al WhatsApp +{ADMIN_WA_NUMBER}
-- Hoy es: {hoy} y la hora actual en Argentina es {ahora_str_argentina()}. Esta es la UNICA fuente de verdad para saber qué turnos ya pasaron. Ignorá cualquier referencia horaria que aparezca en el historial de la conversación — solo cuenta la hora indicada aquí.
-{contexto_telefono}
 
 TU TRABAJO:
 Ayudas a los clientes a hacer reservas, consultar disponibilidad, ver sus reservas, cancelar reservas, ver la grilla del dia.
@@ -512,74 +816,70 @@ Para crear una reserva necesitas recopilar de forma conversacional:
 1. Fecha (la calculas si dicen "manana", "el sabado", etc.)
 2. Hora (la aproximas al turno valido mas cercano si dicen "a las 9 de la noche" -> 21:30, etc.)
 3. Cancha (si no la piden, sugeris la 1 por defecto)
-4. CRITICO — VERIFICAR DISPONIBILIDAD: Apenas tengas fecha + hora + cancha, ANTES de pedirle nombre o telefono al usuario, debés emitir la accion consultar_disponibilidad con esa fecha y hora para confirmar que el turno está libre. Si el turno no está disponible, informáselo al usuario y pedile que elija otro horario o cancha. Solo si el RESULTADO_SISTEMA confirma disponibilidad, continuá con los siguientes pasos.
+4. CRITICO — VERIFICAR DISPONIBILIDAD: Apenas tengas fecha + hora + cancha, ANTES de pedirle nombre o telefono al usuario, debés llamar a la función consultar_disponibilidad con esa fecha y hora para confirmar que el turno está libre. Si el turno no está disponible, informáselo al usuario y pedile que elija otro horario o cancha. Solo si el RESULTADO_SISTEMA confirma disponibilidad, continuá con los siguientes pasos.
 5. Nombre completo
 6. Telefono (pedilo siempre explicitamente si no lo tenes confirmado con este mensaje exacto: "¿Cuál es tu número de celular? Escribilo sin el 0 y sin el 15, solo los 10 dígitos."; NUNCA inventes ni asumas un numero)
 
-Cuando tenes todos los datos y el cliente los confirma, emití la accion correspondiente:
+Cuando tenes todos los datos y el cliente los confirma, llamá a la función correspondiente:
 - Si es UNA sola reserva: usá preparar_reserva
 - Si son DOS O MAS reservas a la vez: usá preparar_multiples_reservas con una lista
-En tu mensaje de texto antes de la accion, mostrale el resumen final de los datos confirmados. NO agregues frases como "voy a procesar", "perfecto, ya lo anoto", ni nada después del resumen. El sistema se encarga del resto automáticamente.
-- CRÍTICO: JAMÁS escribas el JSON o el bloque <ACCION> en texto visible al usuario. El bloque <ACCION> debe ir EXCLUSIVAMENTE entre las etiquetas <ACCION></ACCION> al final del mensaje, nunca como texto plano ni repetido fuera de ellas. Si el JSON aparece visible en el chat, es un error grave.
+En el texto que acompaña la llamada a la función, mostrale el resumen final de los datos confirmados. NO agregues frases como "voy a procesar", "perfecto, ya lo anoto", ni nada después del resumen. El sistema se encarga del resto automáticamente.
+- CRÍTICO: JAMÁS escribas JSON ni los parámetros de una función en el texto visible al usuario. Las acciones se ejecutan EXCLUSIVAMENTE llamando a la función correspondiente. Si el JSON aparece visible en el chat, es un error grave.
 
 IMPORTANTE SOBRE EL PROCESO DE PAGO:
-- Vos solo recopilás los datos y emitís la acción preparar_reserva. El sistema luego le pide al cliente el comprobante de la seña.
-- NUNCA confirmes la reserva como "lista", "guardada" o "registrada" vos mismo. Solo mostrá el resumen y emití la acción. El sistema se encarga del resto.
-- NUNCA le digas al cliente que mande el comprobante — eso lo hace el sistema automáticamente después de tu acción.
-
-ACCIONES DISPONIBLES:
-Cuando tengas toda la info necesaria, incluye al FINAL de tu respuesta un bloque JSON entre etiquetas <ACCION></ACCION>.
-
-Para preparar una reserva (cuando tenes TODOS los datos y el cliente los confirmó):
-<ACCION>{{"tipo": "preparar_reserva", "fecha": "YYYY-MM-DD", "hora": "HH:MM", "cancha_id": 1, "nombre": "Nombre Apellido", "telefono": "1123456789"}}</ACCION>
-
-Para preparar MULTIPLES reservas a la vez (cuando el cliente confirmó 2 o más turnos juntos):
-<ACCION>{{"tipo": "preparar_multiples_reservas", "reservas": [{{"fecha": "YYYY-MM-DD", "hora": "HH:MM", "cancha_id": 1, "nombre": "Nombre Apellido", "telefono": "1123456789"}}, {{"fecha": "YYYY-MM-DD", "hora": "HH:MM", "cancha_id": 1, "nombre": "Nombre Apellido", "telefono": "1123456789"}}]}}</ACCION>
-
-Para consultar disponibilidad de un horario específico:
-<ACCION>{{"tipo": "consultar_disponibilidad", "fecha": "YYYY-MM-DD", "hora": "HH:MM"}}</ACCION>
+- Vos solo recopilás los datos y llamás a la función preparar_reserva. El sistema luego le pide al cliente el comprobante de la seña.
+- NUNCA confirmes la reserva como "lista", "guardada" o "registrada" vos mismo. Solo mostrá el resumen y llamá a la función. El sistema se encarga del resto.
+- NUNCA le digas al cliente que mande el comprobante — eso lo hace el sistema automáticamente después de que llames a la función.
 
-Para consultar qué turnos quedan disponibles en un día (sin hora específica):
-<ACCION>{{"tipo": "consultar_disponibilidad", "fecha": "YYYY-MM-DD"}}</ACCION>
-
-Para ver reservas de un cliente:
-<ACCION>{{"tipo": "consultar_reservas", "telefono": "1123456789"}}</ACCION>
-
-Para cancelar una reserva:
-<ACCION>{{"tipo": "cancelar_reserva", "reserva_id": 42}}</ACCION>
-
-Para cancelar varias reservas a la vez (cuando el usuario quiere cancelar multiples o "todas"):
-<ACCION>{{"tipo": "cancelar_multiples_reservas", "reserva_ids": [42, 43, 44]}}</ACCION>
-
-Para ver la grilla de un dia:
-<ACCION>{{"tipo": "ver_grilla", "fecha": "YYYY-MM-DD"}}</ACCION>
-
-Para derivar a una persona real (cuando el usuario lo pide explicitamente o tiene una consulta que no podés resolver):
-<ACCION>{{"tipo": "derivar_humano", "motivo": "descripcion breve de la consulta"}}</ACCION>
+FUNCIONES DISPONIBLES:
+Las acciones (preparar_reserva, preparar_multiples_reservas, consultar_disponibilidad, consultar_reservas, cancelar_reserva, cancelar_multiples_reservas, ver_grilla, derivar_humano) se ejecutan llamando a la función del mismo nombre. Llamá a una sola función por respuesta.
 
 REGLAS:
-- No incluyas el bloque ACCION hasta tener todos los datos necesarios y confirmados
+- No llames a ninguna función hasta tener todos los datos necesarios y confirmados
 - Si el cliente da una hora aproximada, convierteala al turno valido mas cercano
 - IMPORTANTE: Para crear una reserva solo necesitás fecha, hora, cancha, nombre completo y teléfono. NUNCA preguntes cantidad de personas, nivel de juego, ni ningún otro dato adicional. Si el usuario lo menciona voluntariamente está bien, pero no lo solicites.
-- IMPORTANTE: Nunca ofrezcas ni aceptes reservas para horarios que ya pasaron hoy. Para saber si un turno pasó, usá EXCLUSIVAMENTE la hora indicada en este system prompt (no el historial). Si el usuario pide un turno de hoy que ya pasó según esa hora, informale amablemente y pedile que elija otro horario o fecha. En caso de duda, emití la acción igual — el sistema verificará con la hora exacta.
-- IMPORTANTE: Cuando el usuario pida cancelar una reserva, primero consultá sus reservas activas con consultar_reservas y mostráselas. Esperá que el usuario indique explícitamente cuál quiere cancelar antes de emitir la acción cancelar_reserva o cancelar_multiples_reservas. Nunca cancelés sin confirmación explícita del usuario.
+- IMPORTANTE: Nunca ofrezcas ni aceptes reservas para horarios que ya pasaron hoy. Para saber si un turno pasó, usá EXCLUSIVAMENTE la hora indicada en este system prompt (no el historial). Si el usuario pide un turno de hoy que ya pasó según esa hora, informale amablemente y pedile que elija otro horario o fecha. En caso de duda, llamá a la función igual — el sistema verificará con la hora exacta.
+- IMPORTANTE: Cuando el usuario pida cancelar una reserva, primero consultá sus reservas activas con consultar_reservas y mostráselas. Esperá que el usuario indique explícitamente cuál quiere cancelar antes de llamar a cancelar_reserva o cancelar_multiples_reservas. Nunca cancelés sin confirmación explícita del usuario.
 - IMPORTANTE — POLITICA DE CANCELACION Y SEÑA: Cuando el usuario cancele una reserva, informale siempre la siguiente política antes de proceder:
   * Si cancela con MENOS de 24 horas de anticipación al turno: pierde la seña abonada.
   * Si cancela con 24 horas o más de anticipación: la seña queda guardada y puede usarse para una futura reserva.
   Tras informar la política, esperá confirmación del usuario antes de proceder con la cancelación.
-- IMPORTANTE — CAMBIO DE TURNO: Si el usuario quiere cambiar su turno (de día, hora o cancha), informale que los cambios de turno se gestionan directamente con el administrador y derívalo al WhatsApp +{ADMIN_WA_NUMBER}. Emití también la accion derivar_humano con motivo "cambio de turno". Aclarales además que si avisan el cambio con 24hs o más de anticipación, la seña se les conserva para el nuevo turno.
-- CRÍTICO — OBLIGATORIO: Cuando el usuario pida ver disponibilidad, ver sus reservas o ver la grilla, JAMÁS respondas solo con texto. Tu respuesta DEBE contener el bloque <ACCION> correspondiente. Si no incluís el bloque <ACCION>, es un error grave. Están PROHIBIDAS frases como "Voy a buscar...", "Un momento...", "Ahora consulto...", "Déjame verificar..." o cualquier variante. La única respuesta correcta es emitir la <ACCION> de forma inmediata, sin anunciar que vas a hacerlo.
-- CRÍTICO — PROHIBIDO: JAMÁS liste turnos o canchas disponibles de memoria o por tu cuenta. Nunca respondas con una lista de horarios sin haber emitido primero la <ACCION> consultar_disponibilidad o ver_grilla y recibido el RESULTADO_SISTEMA. Si el usuario pregunta qué turnos quedan para un día, emití consultar_disponibilidad sin hora y esperá el resultado del sistema antes de responder. Inventar disponibilidad es un error grave.
+- IMPORTANTE — CAMBIO DE TURNO: Si el usuario quiere cambiar su turno (de día, hora o cancha), informale que los cambios de turno se gestionan directamente con el administrador y derívalo al WhatsApp +{ADMIN_WA_NUMBER}. Llamá también a la función derivar_humano con motivo "cambio de turno". Aclarales además que si avisan el cambio con 24hs o más de anticipación, la seña se les conserva para el nuevo turno.
+- CRÍTICO — OBLIGATORIO: Cuando el usuario pida ver disponibilidad, ver sus reservas o ver la grilla, JAMÁS respondas solo con texto. Tu respuesta DEBE llamar a la función correspondiente. Si no la llamás, es un error grave. Están PROHIBIDAS frases como "Voy a buscar...", "Un momento...", "Ahora consulto...", "Déjame verificar..." o cualquier variante. La única respuesta correcta es llamar a la función de forma inmediata, sin anunciar que vas a hacerlo.
+- CRÍTICO — PROHIBIDO: JAMÁS liste turnos o canchas disponibles de memoria o por tu cuenta. Nunca respondas con una lista de horarios sin haber llamado primero a consultar_disponibilidad o ver_grilla y recibido el RESULTADO_SISTEMA. Si el usuario pregunta qué turnos quedan para un día, llamá a consultar_disponibilidad sin hora y esperá el resultado del sistema antes de responder. Inventar disponibilidad es un error grave.
 - Cuando recibas un RESULTADO_SISTEMA con TURNO_PASADO, comunicalo de forma amigable y pedile al usuario que elija otro horario.
 - Cuando recibas un RESULTADO_SISTEMA, comunicalo de forma amigable
 - Mantene las respuestas concisas y naturales
 - IMPORTANTE: No uses formato Markdown (sin asteriscos, sin guiones bajos, sin backticks). Texto plano solamente.
 - IMPORTANTE: Jamas uses insultos, groserias ni lenguaje ofensivo, aunque el usuario lo haga. Si insultan, respondé con calma y redirigí la conversacion al tema del club.
 - IMPORTANTE: Está PROHIBIDO usar las siguientes palabras o cualquier variante de ellas, incluso en tono amistoso o coloquial: boludo, pelotudo, cagaste, la concha, la puta, mierda, culo, forro, hdp, hijo de puta, puto, gil, chabón (en tono despectivo), tarado, mogólico, y cualquier otra grosería o insulto del lunfardo argentino. Usá siempre un español rioplatense amigable pero respetuoso y profesional.
-- CRITICO — OBLIGATORIO: Si el usuario pide hablar con una persona, un humano, el encargado, el administrador, un representante, o dice que tiene una consulta especial que no podés resolver, SIEMPRE debés emitir la accion derivar_humano. NUNCA respondas solo con texto dando el número sin emitir la accion. El bloque <ACCION> es OBLIGATORIO en estos casos. En tu respuesta de texto (antes del bloque ACCION) decile que puede contactar al administrador directamente por WhatsApp al +{ADMIN_WA_NUMBER}.
+- CRITICO — OBLIGATORIO: Si el usuario pide hablar con una persona, un humano, el encargado, el administrador, un representante, o dice que tiene una consulta especial que no podés resolver, SIEMPRE debés llamar a la función derivar_humano. NUNCA respondas solo con texto dando el número sin llamar a la función. La llamada es OBLIGATORIA en estos casos. En el texto que acompaña la llamada decile que puede contactar al administrador directamente por WhatsApp al +{ADMIN_WA_NUMBER}.
 """
 
-def ejecutar_accion(accion: dict, telefono_confirmado: str = None) -> str:
+def build_system(hoy: str, telefono_conocido: str = None, nombre_conocido: str = None) -> str:
+    contexto_telefono = ""
+    if telefono_conocido and nombre_conocido:
+        contexto_telefono = (
+            f"\nDATOS DEL USUARIO: Su nombre es {nombre_conocido} y su telefono confirmado es {telefono_conocido}. "
+            f"Si la reserva es a nombre de {nombre_conocido}, usá ese telefono directamente sin pedirlo. "
+            "Si la reserva es a nombre de OTRA persona, pedí el telefono de esa persona explicitamente, no uses el guardado."
+        )
+    elif telefono_conocido:
+        contexto_telefono = (
+            f"\nDATOS DEL USUARIO: Su telefono confirmado es {telefono_conocido}. "
+            "Usalo solo si la reserva es para el mismo usuario; si es para otra persona, pedí su telefono."
+        )
+    return (
+        SYSTEM_STATIC
+        + "\nCONTEXTO ACTUAL:\n"
+        + f"- Hoy es: {hoy} y la hora actual en Argentina es {ahora_str_argentina()}. "
+        "Esta es la UNICA fuente de verdad para saber qué turnos ya pasaron. "
+        "Ignorá cualquier referencia horaria que aparezca en el historial de la conversación — "
+        "solo cuenta la hora indicada aquí."
+        + contexto_telefono
+    )
+
+async def ejecutar_accion(accion: dict, telefono_confirmado: str = None) -> str:
     tipo = accion.get("tipo")
 
     if tipo == "derivar_humano":
@@ -587,23 +887,22 @@ def ejecutar_accion(accion: dict, telefono_confirmado: str = None) -> str:
         return f"DERIVAR_HUMANO:{motivo}"
 
     if tipo == "preparar_reserva":
+        if not hora_valida(accion.get("hora")):
+            return mensaje_hora_invalida(accion.get("hora"))
         hoy_str = hoy_argentina()
         if accion["fecha"] == hoy_str:
             ahora = ahora_arg()
-            hora_turno = datetime.strptime(accion["hora"], "%H:%M").replace(
-                year=ahora.year, month=ahora.month, day=ahora.day, tzinfo=ZONA_ARG
-            )
-            if hora_turno <= ahora:
+            if turno_ya_paso(accion["hora"], ahora):
                 return (
                     f"TURNO_PASADO: El turno de las {accion['hora']} de hoy ya pasó. "
                     f"Elegí un horario posterior a las {ahora.strftime('%H:%M')}."
                 )
-        libres = canchas_libres(accion["fecha"], accion["hora"])
+        libres = await canchas_libres(accion["fecha"], accion["hora"])
         if accion["cancha_id"] not in libres:
             if libres:
                 return (
                     f"CANCHA_NO_DISPONIBLE: La cancha {accion['cancha_id']} ya no está libre. "
-                    f"Disponibles: {', '.join(CANCHAS[c] for c in libres)}"
+                    f"Disponibles: {', '.join(NOMBRE_CANCHA[c] for c in libres)}"
                 )
             return f"CANCHA_NO_DISPONIBLE: No hay canchas libres para {accion['fecha']} a las {accion['hora']}."
         return "RESERVA_LISTA"
@@ -612,24 +911,25 @@ def ejecutar_accion(accion: dict, telefono_confirmado: str = None) -> str:
         reservas = accion.get("reservas", [])
         if not reservas:
             return "No se especificaron reservas."
+        for r in reservas:
+            if not hora_valida(r.get("hora")):
+                return mensaje_hora_invalida(r.get("hora"))
         hoy_str = hoy_argentina()
         ahora = ahora_arg()
-        for r in reservas:
+        # Una sola consulta para todos los turnos del lote
+        libres_por_turno = await canchas_libres_turnos([(r["fecha"], r["hora"]) for r in reservas])
+        for r, libres in zip(reservas, libres_por_turno):
             if r["fecha"] == hoy_str:
-                hora_turno = datetime.strptime(r["hora"], "%H:%M").replace(
-                    year=ahora.year, month=ahora.month, day=ahora.day, tzinfo=ZONA_ARG
-                )
-                if hora_turno <= ahora:
+                if turno_ya_paso(r["hora"], ahora):
                     return (
                         f"TURNO_PASADO: El turno de las {r['hora']} de hoy ya pasó. "
                         f"Elegí un horario posterior a las {ahora.strftime('%H:%M')}."
                     )
-            libres = canchas_libres(r["fecha"], r["hora"])
             if r["cancha_id"] not in libres:
                 if libres:
                     return (
                         f"CANCHA_NO_DISPONIBLE: La cancha {r['cancha_id']} para las {r['hora']} no está libre. "
-                        f"Disponibles: {', '.join(CANCHAS[c] for c in libres)}"
+                        f"Disponibles: {', '.join(NOMBRE_CANCHA[c] for c in libres)}"
                     )
                 return f"CANCHA_NO_DISPONIBLE: No hay canchas libres para {r['fecha']} a las {r['hora']}."
         return "MULTIPLES_RESERVAS_LISTAS"
@@ -641,41 +941,38 @@ def ejecutar_accion(accion: dict, telefono_confirmado: str = None) -> str:
             # Modo "qué turnos quedan": devolver todos los slots con al menos una cancha libre
             ahora = ahora_arg()
             hoy_str = hoy_argentina()
-            turnos_libres = []
-            for slot in HORARIOS:
-                # Saltar turnos pasados si es hoy
-                if fecha == hoy_str:
-                    hora_slot = datetime.strptime(slot, "%H:%M").replace(
-                        year=ahora.year, month=ahora.month, day=ahora.day, tzinfo=ZONA_ARG
-                    )
-                    if hora_slot <= ahora:
-                        continue
-                libres = canchas_libres(fecha, slot)
-                if libres:
-                    turnos_libres.append(slot)
+            # Saltar turnos pasados si es hoy
+            slots = [
+                slot for slot in HORARIOS
+                if not (fecha == hoy_str and turno_ya_paso(slot, ahora))
+            ]
+            libres_por_slot = await canchas_libres_turnos([(fecha, slot) for slot in slots])
+            turnos_libres = [slot for slot, libres in zip(slots, libres_por_slot) if libres]
             if turnos_libres:
                 return f"Turnos con canchas disponibles el {fecha}: {', '.join(turnos_libres)}"
             return f"No hay turnos disponibles el {fecha}."
         # Modo hora específica
-        libres = canchas_libres(fecha, hora)
+        if not hora_valida(hora):
+            return mensaje_hora_invalida(hora)
+        libres = await canchas_libres(fecha, hora)
         if libres:
-            nombres = [CANCHAS[c] for c in libres]
+            nombres = [NOMBRE_CANCHA[c] for c in libres]
             return f"Canchas libres el {fecha} a las {hora}: {', '.join(nombres)}"
         return f"No hay canchas disponibles el {fecha} a las {hora}."
 
     elif tipo == "consultar_reservas":
-        reservas = reservas_por_telefono(accion["telefono"])
+        reservas = await reservas_por_telefono(accion["telefono"])
         if not reservas:
             return f"No hay reservas activas para el telefono {accion['telefono']}."
         lineas = [
-            f"#{r['id']} - {r['fecha']} {r['hora']} - {CANCHAS[r['cancha_id']]} - {r['nombre_cliente']}"
+            f"#{r['id']} - {r['fecha']} {r['hora']} - {NOMBRE_CANCHA[r['cancha_id']]} - {r['nombre_cliente']}"
             for r in reservas
         ]
         return "Reservas encontradas:\n" + "\n".join(lineas)
 
     elif tipo == "cancelar_reserva":
         rid = accion["reserva_id"]
-        reserva = reserva_por_id(rid)
+        reserva = await reserva_por_id(rid)
         if not reserva:
             return f"No existe la reserva #{rid}."
         if reserva.get("estado") == "cancelada":
@@ -684,10 +981,10 @@ def ejecutar_accion(accion: dict, telefono_confirmado: str = None) -> str:
             return "CANCELACION_DENEGADA: No tengo tu número de teléfono confirmado. Por favor consultá tus reservas primero indicando tu número."
         if normalizar_telefono(reserva.get("telefono_cliente", "")) != normalizar_telefono(telefono_confirmado):
             return f"CANCELACION_DENEGADA: La reserva #{rid} no pertenece a tu número de teléfono."
-        if cancelar_reserva_bd(rid):
+        if await cancelar_reserva_bd(rid):
             return (
                 f"Reserva #{rid} cancelada. Era: {reserva['fecha']} {reserva['hora']} "
-                f"- {CANCHAS[reserva['cancha_id']]} - {reserva['nombre_cliente']}"
+                f"- {NOMBRE_CANCHA[reserva['cancha_id']]} - {reserva['nombre_cliente']}"
             )
         return "ERROR al cancelar."
 
@@ -697,25 +994,37 @@ def ejecutar_accion(accion: dict, telefono_confirmado: str = None) -> str:
             return "No se especificaron reservas para cancelar."
         if not telefono_confirmado:
             return "CANCELACION_DENEGADA: No tengo tu número de teléfono confirmado. Por favor consultá tus reservas primero indicando tu número."
+        # Una consulta para leer todas y un único UPDATE para las que corresponda cancelar
+        existentes = await reservas_por_ids(ids)
+        if existentes is None:
+            return "ERROR al cancelar."
+        telefono_norm = normalizar_telefono(telefono_confirmado)
+        a_cancelar = [
+            rid for rid in dict.fromkeys(ids)
+            if rid in existentes
+            and existentes[rid].get("estado") != "cancelada"
+            and normalizar_telefono(existentes[rid].get("telefono_cliente", "")) == telefono_norm
+        ]
+        cancelacion_ok = await cancelar_reservas_bd(a_cancelar) if a_cancelar else True
         resultados = []
         for rid in ids:
-            reserva = reserva_por_id(rid)
+            reserva = existentes.get(rid)
             if not reserva:
                 resultados.append(f"#{rid}: no existe")
             elif reserva.get("estado") == "cancelada":
                 resultados.append(f"#{rid}: ya estaba cancelada")
-            elif normalizar_telefono(reserva.get("telefono_cliente", "")) != normalizar_telefono(telefono_confirmado):
+            elif normalizar_telefono(reserva.get("telefono_cliente", "")) != telefono_norm:
                 resultados.append(f"#{rid}: no pertenece a tu número")
-            elif cancelar_reserva_bd(rid):
+            elif cancelacion_ok:
                 resultados.append(
-                    f"#{rid} cancelada ({reserva['fecha']} {reserva['hora']} - {CANCHAS[reserva['cancha_id']]})"
+                    f"#{rid} cancelada ({reserva['fecha']} {reserva['hora']} - {NOMBRE_CANCHA[reserva['cancha_id']]})"
                 )
             else:
                 resultados.append(f"#{rid}: error al cancelar")
         return "Resultado cancelaciones:\n" + "\n".join(resultados)
 
     elif tipo == "ver_grilla":
-        return grilla_texto(accion["fecha"])
+        return await grilla_texto(accion["fecha"])
 
     return "Accion no reconocida."
 
@@ -747,42 +1056,162 @@ def formatear_disponibilidad(resultado: str, accion: dict) -> str:
             return f"Estos son los turnos disponibles para el {fecha}: {turnos_str}. ¿Cuál te viene bien?"
 
 
-def llamar_mistral(
+async def compactar_historial(historial: deque):
+    """
+    Si el turno que empieza podría desbordar MAX_HISTORIAL, reemplaza (in place) los
+    primeros HISTORIAL_A_RESUMIR mensajes por un resumen generado con mistral-small.
+    Si el resumen falla, no se toca nada: el deque igual descarta los más viejos.
+    """
+    if len(historial) + MENSAJES_POR_TURNO <= MAX_HISTORIAL:
+        return
+    viejos = list(islice(historial, HISTORIAL_A_RESUMIR))
+    transcripcion = "\n".join(f"{m['role']}: {m['content']}" for m in viejos)
+    try:
+        response = await mistral_chat(
+            model="mistral-small-latest",
+            max_tokens=300,
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "Resumí en pocas líneas, en español, esta conversación entre un cliente y el "
+                        "asistente de reservas de un club de pádel. Conservá solo los datos útiles para "
+                        "seguir atendiendo: fechas, horas, canchas, nombre, teléfono, números de reserva "
+                        "y pedidos pendientes. Texto plano, sin Markdown."
+                    ),
+                },
+                {"role": "user", "content": transcripcion},
+            ],
+        )
+        resumen = response.choices[0].message.content.strip()
+    except Exception as e:
+        logger.error(f"Error resumiendo historial: {e}")
+        return
+    for _ in range(HISTORIAL_A_RESUMIR):
+        historial.popleft()
+    historial.appendleft({"role": "system", "content": f"RESUMEN DE LA CONVERSACION PREVIA: {resumen}"})
+
+def _funcion(nombre: str, descripcion: str, propiedades: dict, requeridos: list) -> dict:
+    return {
+        "type": "function",
+        "function": {
+            "name": nombre,
+            "description": descripcion,
+            "parameters": {"type": "object", "properties": propiedades, "required": requeridos},
+        },
+    }
+
+_FECHA = {"type": "string", "description": "Fecha en formato YYYY-MM-DD"}
+_HORA = {"type": "string", "description": "Hora de inicio del turno en formato HH:MM"}
+_RESERVA = {
+    "fecha": _FECHA,
+    "hora": _HORA,
+    "cancha_id": {"type": "integer", "enum": list(CANCHAS)},
+    "nombre": {"type": "string", "description": "Nombre y apellido del titular"},
+    "telefono": {"type": "string", "description": "Celular de 10 dígitos, sin 0 ni 15"},
+}
+
+# Acciones que Mistral puede pedir vía tool-calling. El nombre de la función es el
+# "tipo" que recibe ejecutar_accion y sus argumentos el resto de la acción.
+ACCIONES_TOOLS = [
+    _funcion(
+        "preparar_reserva",
+        "Prepara UNA reserva cuando tenés todos los datos y el cliente los confirmó.",
+        _RESERVA, list(_RESERVA),
+    ),
+    _funcion(
+        "preparar_multiples_reservas",
+        "Prepara DOS O MAS reservas juntas cuando el cliente confirmó todos los turnos.",
+        {"reservas": {
+            "type": "array",
+            "items": {"type": "object", "properties": _RESERVA, "required": list(_RESERVA)},
+        }},
+        ["reservas"],
+    ),
+    _funcion(
+        "consultar_disponibilidad",
+        "Consulta las canchas libres en una fecha y hora. Sin hora, devuelve los turnos que quedan en el día.",
+        {"fecha": _FECHA, "hora": _HORA},
+        ["fecha"],
+    ),
+    _funcion(
+        "consultar_reservas",
+        "Lista las reservas activas de un teléfono.",
+        {"telefono": _RESERVA["telefono"]},
+        ["telefono"],
+    ),
+    _funcion(
+        "cancelar_reserva",
+        "Cancela una reserva por su ID, solo con confirmación explícita del usuario.",
+        {"reserva_id": {"type": "integer"}},
+        ["reserva_id"],
+    ),
+    _funcion(
+        "cancelar_multiples_reservas",
+        "Cancela varias reservas por ID, solo con confirmación explícita del usuario.",
+        {"reserva_ids": {"type": "array", "items": {"type": "integer"}}},
+        ["reserva_ids"],
+    ),
+    _funcion(
+        "ver_grilla",
+        "Muestra la grilla de reservas de un día.",
+        {"fecha": _FECHA},
+        ["fecha"],
+    ),
+    _funcion(
+        "derivar_humano",
+        "Deriva la consulta a una persona del club (pedido explícito o consulta que no podés resolver).",
+        {"motivo": {"type": "string", "description": "Descripción breve de la consulta"}},
+        ["motivo"],
+    ),
+]
+
+async def llamar_mistral(
     historial: list,
     hoy: str,
     telefono_conocido: str = None,
     nombre_conocido: str = None,
+    tool_choice: str = "auto",
 ) -> tuple:
     """
-    Llama a mistral-large-2411 con el historial de conversación.
+    Llama a mistral-large-2411 con el historial de conversación y las acciones como tools.
+    Con tool_choice="any" el modelo está obligado a llamar a alguna función.
     Retorna (texto_respuesta, accion_dict | None).
     """
-    messages = [{"role": "system", "content": build_system(hoy, telefono_conocido, nombre_conocido)}]
-    messages.extend(historial)
+    # Los resúmenes de turnos viejos (role "system" dentro del historial) se agregan
+    # al final del system prompt en lugar de mandarse como mensajes sueltos.
+    system = build_system(hoy, telefono_conocido, nombre_conocido)
+    messages = [{"role": "system", "content": system}]
+    for m in historial:
+        if m["role"] == "system":
+            messages[0]["content"] += "\n" + m["content"]
+        else:
+            messages.append(m)
 
-    response = mistral.chat.complete(
+    response = await mistral_chat(
         model="mistral-large-2411",
         max_tokens=800,
         messages=messages,
+        tools=ACCIONES_TOOLS,
+        tool_choice=tool_choice,
     )
-    respuesta = response.choices[0].message.content
+    mensaje = response.choices[0].message
+    texto = (mensaje.content or "").strip()
     accion = None
-    texto = respuesta
 
-    if "<ACCION>" in respuesta and "</ACCION>" in respuesta:
-        i = respuesta.find("<ACCION>")
-        f = respuesta.find("</ACCION>") + len("</ACCION>")
-        bloque = respuesta[i:f]
-        texto = (respuesta[:i] + respuesta[f:]).strip()
+    if mensaje.tool_calls:
+        funcion = mensaje.tool_calls[0].function
         try:
-            json_str = bloque.replace("<ACCION>", "").replace("</ACCION>", "").strip()
-            accion = json.loads(json_str)
+            argumentos = funcion.arguments
+            if isinstance(argumentos, str):
+                argumentos = orjson.loads(argumentos) if argumentos.strip() else {}
+            accion = {**argumentos, "tipo": funcion.name}
         except Exception as e:
-            logger.error(f"Error parseando accion JSON: {e}")
+            logger.error(f"Error parseando argumentos de {funcion.name}: {e}")
 
-    # Si el texto quedó vacío (Mistral respondió solo con <ACCION>), usar "." internamente
-    # para no romper la API de Mistral en llamadas subsiguientes. Este "." NUNCA se envía
-    # al usuario — los guards en manejar_mensaje_wa lo filtran antes de enviarlo.
+    # Si el texto quedó vacío (Mistral respondió solo con la llamada a la función), usar "."
+    # internamente para no romper la API de Mistral en llamadas subsiguientes. Este "." NUNCA
+    # se envía al usuario — los guards en manejar_mensaje_wa lo filtran antes de enviarlo.
     if not texto:
         texto = "."
 
@@ -790,525 +1219,589 @@ def llamar_mistral(
 
 # ── Lógica de mensajes WhatsApp ───────────────
 
-def manejar_mensaje_wa(wa_id: str, texto_usuario: str):
-    """Procesa un mensaje de texto entrante de WhatsApp."""
-    hoy = hoy_argentina()
-    sesion = sesion_get(wa_id)
+# Palabras que cancelan el proceso mientras se espera el comprobante
+_CANCELAR_RE = re.compile(
+    r"cancelar|cancel|no quiero|olvidate|dejalo|salir|no importa|abort",
+    re.IGNORECASE,
+)
 
-    # Si estamos esperando comprobante, solo aceptamos cancelación o recordamos
-    if sesion["esperando_comprobante"]:
-        palabras_cancelar = [
-            "cancelar", "cancel", "no quiero", "olvidate", "dejalo",
-            "salir", "no importa", "abort",
-        ]
-        if any(p in texto_usuario.lower() for p in palabras_cancelar):
-            sesion["esperando_comprobante"] = False
-            sesion["reserva_pendiente"] = None
-            sesion["historial"] = []
-            sesion_set(wa_id, sesion)
-            enviar_mensaje_whatsapp(
-                wa_id,
-                "Entendido, cancelé el proceso de reserva. Si en algún momento querés intentarlo de nuevo, avisame.",
-            )
-        else:
-            enviar_mensaje_whatsapp(
-                wa_id,
-                "Estoy esperando el comprobante de la seña para confirmar tu reserva. "
-                "Si querés cancelar el proceso, escribí 'cancelar'.",
-            )
+MENSAJE_SENA_UNA = (
+    "Perfecto! Para confirmar tu reserva necesitás abonar una seña de $10.000 "
+    "por transferencia bancaria a Alejandro Santillan.\n\n"
+    "Alias: lcpadel.mp\n"
+    "Cuenta: Mercado Pago\n\n"
+    "Una vez que hagas la transferencia, mandame la foto del comprobante y confirmo tu reserva."
+)
+
+def pedir_sena(wa_id: str, sesion: dict, accion: dict, resultado: str):
+    """Deja la sesión esperando el comprobante y le pasa al usuario los datos para la seña."""
+    if resultado == "RESERVA_LISTA":
+        reservas = [{
+            "fecha": accion["fecha"],
+            "hora": accion["hora"],
+            "cancha_id": accion["cancha_id"],
+            "nombre": accion["nombre"],
+            "telefono": accion["telefono"],
+        }]
+    else:
+        reservas = accion["reservas"]
+    sesion["reserva_pendiente"] = reservas
+    sesion["esperando_comprobante"] = True
+    sesion["esperando_desde"] = ahora_arg().isoformat()
+    sesion["historial"] = []
+    if resultado == "RESERVA_LISTA":
+        programar_envio_whatsapp(wa_id, MENSAJE_SENA_UNA)
         return
+    cantidad = len(reservas)
+    monto_fmt = monto_senas_fmt(cantidad)
+    programar_envio_whatsapp(
+        wa_id,
+        f"Perfecto! Para confirmar tus {cantidad} reservas necesitás abonar una seña de ${monto_fmt} "
+        f"({cantidad} x $10.000) por transferencia bancaria a Alejandro Santillan.\n\n"
+        "Alias: lcpadel.mp\n"
+        "Cuenta: Mercado Pago\n\n"
+        f"Podés hacer una sola transferencia de ${monto_fmt} o varias de $10.000 cada una. "
+        f"Mandame la foto de cada comprobante y confirmo tus reservas.",
+    )
 
-    historial = sesion["historial"]
+def cerrar_turno(wa_id: str, sesion: dict, historial: deque, texto: str):
+    """
+    Guarda la respuesta del asistente en el historial de la sesión y se la manda
+    al usuario. El placeholder interno "." no se guarda ni se envía.
+    """
+    if texto and texto != ".":
+        historial.append({"role": "assistant", "content": texto})
+    sesion["historial"] = historial
+    if texto and texto != ".":
+        programar_envio_whatsapp(wa_id, texto)
+
+def agregar_resultado(historial: deque, texto: str, resultado: str):
+    """Agrega la respuesta previa del asistente (si la hay) y el resultado de la función."""
+    if texto and texto != ".":  # no guardar strings vacíos ni el placeholder interno
+        historial.append({"role": "assistant", "content": texto})
+    historial.append({"role": "user", "content": f"<RESULTADO_SISTEMA>{resultado}</RESULTADO_SISTEMA>"})
+
+# ── Manejo del resultado de una acción ───────
+# Todos reciben (wa_id, sesion, historial, accion, resultado, texto_respuesta, texto_usuario, hoy).
+# Teléfono y nombre conocidos salen de la sesión, que ya incorporó los datos de la acción.
+
+async def _tras_reserva_lista(wa_id, sesion, historial, accion, resultado, texto_respuesta, texto_usuario, hoy):
+    pedir_sena(wa_id, sesion, accion, resultado)
+
+async def _tras_derivar_humano(wa_id, sesion, historial, accion, resultado, texto_respuesta, texto_usuario, hoy):
+    motivo = resultado.replace("DERIVAR_HUMANO:", "").strip()
+    logger.warning(
+        f"[DERIVAR_HUMANO] wa_id={wa_id} | telefono={sesion.get('telefono_confirmado')} | motivo={motivo}"
+    )
+    # Notificación al admin por WhatsApp
+    telefono_usuario = sesion.get("telefono_confirmado") or wa_id
+    nombre_usuario = sesion.get("nombre_confirmado") or "desconocido"
+    notif = (
+        f"[Los Ciruelos Bot] Un cliente quiere hablar con una persona.\n\n"
+        f"Nombre: {nombre_usuario}\n"
+        f"Teléfono/wa_id: {telefono_usuario}\n"
+        f"Motivo: {motivo}"
+    )
+    programar_envio_whatsapp(ADMIN_WA_NUMBER, notif)
+    cerrar_turno(wa_id, sesion, historial, texto_respuesta)
+
+async def _tras_cancelacion_denegada(wa_id, sesion, historial, accion, resultado, texto_respuesta, texto_usuario, hoy):
+    cerrar_turno(wa_id, sesion, historial, resultado.split(": ", 1)[-1])
+
+async def _tras_rechazo(wa_id, sesion, historial, accion, resultado, texto_respuesta, texto_usuario, hoy):
+    """CANCHA_NO_DISPONIBLE, TURNO_PASADO y HORA_INVALIDA: Mistral traduce el motivo al usuario."""
     telefono_conocido = sesion["telefono_confirmado"]
     nombre_conocido = sesion.get("nombre_confirmado")
-    historial.append({"role": "user", "content": texto_usuario})
+    agregar_resultado(historial, texto_respuesta, resultado.split(": ", 1)[-1])
+    # Limpiar historial largo para evitar que Mistral reutilice horarios viejos
+    historial_limpio = list(historial)[-6:]
+    texto_final, _ = await llamar_mistral(historial_limpio, hoy, telefono_conocido, nombre_conocido)
+    cerrar_turno(wa_id, sesion, historial, texto_final)
 
-    try:
-        texto_respuesta, accion = llamar_mistral(historial, hoy, telefono_conocido, nombre_conocido)
-
-        if accion:
-            resultado = ejecutar_accion(accion, sesion.get("telefono_confirmado"))
-            logger.info(f"Accion: {accion.get('tipo')} | Resultado: {resultado[:80]}")
-
-            # Extraer teléfono/nombre de la acción
-            telefono_en_accion = accion.get("telefono")
-            nombre_en_accion = accion.get("nombre")
-            if not telefono_en_accion and accion.get("reservas"):
-                telefono_en_accion = accion["reservas"][0].get("telefono")
-            if not nombre_en_accion and accion.get("reservas"):
-                nombre_en_accion = accion["reservas"][0].get("nombre")
-            if telefono_en_accion and not sesion.get("telefono_confirmado"):
-                sesion["telefono_confirmado"] = normalizar_telefono(telefono_en_accion)
-                telefono_conocido = sesion["telefono_confirmado"]
-            if nombre_en_accion and not sesion.get("nombre_confirmado"):
-                sesion["nombre_confirmado"] = nombre_en_accion
-                nombre_conocido = nombre_en_accion
-
-            logger.info(f"Resultado accion: '{resultado}'")
-
-            if resultado == "RESERVA_LISTA":
-                sesion["reserva_pendiente"] = [{
-                    "fecha": accion["fecha"],
-                    "hora": accion["hora"],
-                    "cancha_id": accion["cancha_id"],
-                    "nombre": accion["nombre"],
-                    "telefono": accion["telefono"],
-                }]
-                sesion["esperando_comprobante"] = True
-                sesion["esperando_desde"] = ahora_arg().isoformat()
+async def _tras_resultado_general(wa_id, sesion, historial, accion, resultado, texto_respuesta, texto_usuario, hoy):
+    telefono_conocido = sesion["telefono_confirmado"]
+    nombre_conocido = sesion.get("nombre_confirmado")
+    agregar_resultado(historial, texto_respuesta, resultado)
+
+    # Para consultar_disponibilidad: construir el mensaje directo en código,
+    # sin pasar por Mistral, para evitar que complete la lista con horarios de memoria.
+    if accion.get("tipo") == "consultar_disponibilidad":
+        cerrar_turno(wa_id, sesion, historial, formatear_disponibilidad(resultado, accion))
+        return
+
+    historial_limpio = list(historial)[-12:]
+    texto_final, accion_final = await llamar_mistral(historial_limpio, hoy, telefono_conocido, nombre_conocido)
+    # Si Mistral volvió a emitir una ACCION en la segunda llamada, procesarla correctamente
+    # en lugar de mandar el texto (que podría contener JSON crudo)
+    if accion_final:
+        logger.warning(f"Mistral emitió ACCION inesperada en segunda llamada: {accion_final.get('tipo')}. Reprocesando.")
+        resultado2 = await ejecutar_accion(accion_final, sesion.get("telefono_confirmado"))
+        logger.info(f"Resultado segunda accion: '{resultado2}'")
+        if resultado2 in ("RESERVA_LISTA", "MULTIPLES_RESERVAS_LISTAS"):
+            pedir_sena(wa_id, sesion, accion_final, resultado2)
+        else:
+            # Para cualquier otro resultado, seguir el flujo normal.
+            # Se descarta cualquier ACCION que Mistral emita en esta llamada —
+            # solo queremos texto natural para comunicar el resultado al usuario.
+            agregar_resultado(historial, texto_final, resultado2)
+            texto_final2, accion_descartada = await llamar_mistral(historial, hoy, telefono_conocido, nombre_conocido)
+            if accion_descartada:
+                logger.warning(f"Mistral emitió ACCION inesperada en llamada de traducción (ignorada): {accion_descartada.get('tipo')}")
+            cerrar_turno(wa_id, sesion, historial, texto_final2)
+    else:
+        cerrar_turno(wa_id, sesion, historial, texto_final)
+
+# Se busca por el prefijo del resultado (lo anterior al primer ":"), con una sola consulta al dict
+_TRAS_ACCION = {
+    "RESERVA_LISTA": _tras_reserva_lista,
+    "MULTIPLES_RESERVAS_LISTAS": _tras_reserva_lista,
+    "DERIVAR_HUMANO": _tras_derivar_humano,
+    "CANCELACION_DENEGADA": _tras_cancelacion_denegada,
+    "CANCHA_NO_DISPONIBLE": _tras_rechazo,
+    "TURNO_PASADO": _tras_rechazo,
+    "HORA_INVALIDA": _tras_rechazo,
+}
+
+async def manejar_mensaje_wa(wa_id: str, texto_usuario: str):
+    """Procesa un mensaje de texto entrante de WhatsApp."""
+    hoy = hoy_argentina()
+    async with SesionCtx(wa_id) as ctx:
+        sesion = ctx.sesion
+
+        # Si estamos esperando comprobante, solo aceptamos cancelación o recordamos
+        if sesion["esperando_comprobante"]:
+            if _CANCELAR_RE.search(texto_usuario):
+                sesion["esperando_comprobante"] = False
+                sesion["reserva_pendiente"] = None
                 sesion["historial"] = []
-                sesion_set(wa_id, sesion)
-                enviar_mensaje_whatsapp(
+                programar_envio_whatsapp(
                     wa_id,
-                    "Perfecto! Para confirmar tu reserva necesitás abonar una seña de $10.000 "
-                    "por transferencia bancaria a Alejandro Santillan.\n\n"
-                    "Alias: lcpadel.mp\n"
-                    "Cuenta: Mercado Pago\n\n"
-                    "Una vez que hagas la transferencia, mandame la foto del comprobante y confirmo tu reserva.",
+                    "Entendido, cancelé el proceso de reserva. Si en algún momento querés intentarlo de nuevo, avisame.",
                 )
-
-            elif resultado == "MULTIPLES_RESERVAS_LISTAS":
-                cantidad = len(accion["reservas"])
-                monto_total = cantidad * SENA_MONTO
-                monto_fmt = f"{monto_total:,}".replace(",", ".")
-                sesion["reserva_pendiente"] = accion["reservas"]
-                sesion["esperando_comprobante"] = True
-                sesion["esperando_desde"] = ahora_arg().isoformat()
-                sesion["historial"] = []
-                sesion_set(wa_id, sesion)
-                enviar_mensaje_whatsapp(
+            else:
+                programar_envio_whatsapp(
                     wa_id,
-                    f"Perfecto! Para confirmar tus {cantidad} reservas necesitás abonar una seña de ${monto_fmt} "
-                    f"({cantidad} x $10.000) por transferencia bancaria a Alejandro Santillan.\n\n"
-                    "Alias: lcpadel.mp\n"
-                    "Cuenta: Mercado Pago\n\n"
-                    f"Podés hacer una sola transferencia de ${monto_fmt} o varias de $10.000 cada una. "
-                    f"Mandame la foto de cada comprobante y confirmo tus reservas.",
+                    "Estoy esperando el comprobante de la seña para confirmar tu reserva. "
+                    "Si querés cancelar el proceso, escribí 'cancelar'.",
                 )
+            return
 
-            elif resultado.startswith("DERIVAR_HUMANO:"):
-                motivo = resultado.replace("DERIVAR_HUMANO:", "").strip()
-                historial.append({"role": "assistant", "content": texto_respuesta})
-                sesion["historial"] = historial[-20:]
-                sesion_set(wa_id, sesion)
-                logger.warning(
-                    f"[DERIVAR_HUMANO] wa_id={wa_id} | telefono={sesion.get('telefono_confirmado')} | motivo={motivo}"
-                )
-                # Notificación al admin por WhatsApp
-                telefono_usuario = sesion.get("telefono_confirmado") or wa_id
-                nombre_usuario = sesion.get("nombre_confirmado") or "desconocido"
-                notif = (
-                    f"[Los Ciruelos Bot] Un cliente quiere hablar con una persona.\n\n"
-                    f"Nombre: {nombre_usuario}\n"
-                    f"Teléfono/wa_id: {telefono_usuario}\n"
-                    f"Motivo: {motivo}"
-                )
-                enviar_mensaje_whatsapp(ADMIN_WA_NUMBER, notif)
-                enviar_mensaje_whatsapp(wa_id, texto_respuesta)
-
-            elif resultado.startswith("CANCELACION_DENEGADA:"):
-                mensaje = resultado.split(": ", 1)[-1]
-                historial.append({"role": "assistant", "content": mensaje})
-                sesion["historial"] = historial[-20:]
-                sesion_set(wa_id, sesion)
-                enviar_mensaje_whatsapp(wa_id, mensaje)
-
-            elif resultado.startswith("CANCHA_NO_DISPONIBLE") or resultado.startswith("TURNO_PASADO"):
-                mensaje_sistema = resultado.split(": ", 1)[-1]
-                if texto_respuesta and texto_respuesta != ".":  # no guardar strings vacíos ni el placeholder interno
-                    historial.append({"role": "assistant", "content": texto_respuesta})
-                historial.append({"role": "user", "content": f"<RESULTADO_SISTEMA>{mensaje_sistema}</RESULTADO_SISTEMA>"})
-                # Limpiar historial largo para evitar que Mistral reutilice horarios viejos
-                historial_limpio = historial[-6:]
-                texto_final, _ = llamar_mistral(historial_limpio, hoy, telefono_conocido, nombre_conocido)
-                historial.append({"role": "assistant", "content": texto_final})
-                sesion["historial"] = historial[-20:]
-                sesion_set(wa_id, sesion)
-                enviar_mensaje_whatsapp(wa_id, texto_final)
+        historial = sesion["historial"]
+        telefono_conocido = sesion["telefono_confirmado"]
+        nombre_conocido = sesion.get("nombre_confirmado")
+
+        try:
+            # Compactar antes de agregar el mensaje nuevo, dejando lugar para todo el turno:
+            # si el deque se llena a mitad de turno, los append descartan el resumen y
+            # mensajes que nunca entraron en él.
+            await compactar_historial(historial)
+            historial.append({"role": "user", "content": texto_usuario})
+            texto_respuesta, accion = await llamar_mistral(historial, hoy, telefono_conocido, nombre_conocido)
+
+            if accion:
+                resultado = await ejecutar_accion(accion, sesion.get("telefono_confirmado"))
+                logger.info(f"Accion: {accion.get('tipo')} | Resultado: {resultado[:80]}")
+
+                # Extraer teléfono/nombre de la acción
+                telefono_en_accion = accion.get("telefono")
+                nombre_en_accion = accion.get("nombre")
+                if not telefono_en_accion and accion.get("reservas"):
+                    telefono_en_accion = accion["reservas"][0].get("telefono")
+                if not nombre_en_accion and accion.get("reservas"):
+                    nombre_en_accion = accion["reservas"][0].get("nombre")
+                if telefono_en_accion and not sesion.get("telefono_confirmado"):
+                    sesion["telefono_confirmado"] = normalizar_telefono(telefono_en_accion)
+                    telefono_conocido = sesion["telefono_confirmado"]
+                if nombre_en_accion and not sesion.get("nombre_confirmado"):
+                    sesion["nombre_confirmado"] = nombre_en_accion
+                    nombre_conocido = nombre_en_accion
+
+                logger.info(f"Resultado accion: '{resultado}'")
+
+                manejador = _TRAS_ACCION.get(resultado.split(":", 1)[0], _tras_resultado_general)
+                await manejador(wa_id, sesion, historial, accion, resultado, texto_respuesta, texto_usuario, hoy)
 
             else:
-                if texto_respuesta and texto_respuesta != ".":  # no guardar strings vacíos ni el placeholder interno
-                    historial.append({"role": "assistant", "content": texto_respuesta})
-                historial.append({"role": "user", "content": f"<RESULTADO_SISTEMA>{resultado}</RESULTADO_SISTEMA>"})
-
-                # Para consultar_disponibilidad: construir el mensaje directo en código,
-                # sin pasar por Mistral, para evitar que complete la lista con horarios de memoria.
-                if accion.get("tipo") == "consultar_disponibilidad":
-                    texto_final = formatear_disponibilidad(resultado, accion)
-                    historial.append({"role": "assistant", "content": texto_final})
-                    sesion["historial"] = historial
-                    sesion_set(wa_id, sesion)
-                    enviar_mensaje_whatsapp(wa_id, texto_final)
-                    return
-
-                historial_limpio = historial[-12:]
-                texto_final, accion_final = llamar_mistral(historial_limpio, hoy, telefono_conocido, nombre_conocido)
-                # Si Mistral volvió a emitir una ACCION en la segunda llamada, procesarla correctamente
-                # en lugar de mandar el texto (que podría contener JSON crudo)
-                if accion_final:
-                    logger.warning(f"Mistral emitió ACCION inesperada en segunda llamada: {accion_final.get('tipo')}. Reprocesando.")
-                    resultado2 = ejecutar_accion(accion_final, sesion.get("telefono_confirmado"))
-                    logger.info(f"Resultado segunda accion: '{resultado2}'")
-                    if resultado2 == "RESERVA_LISTA":
-                        sesion["reserva_pendiente"] = [{
-                            "fecha": accion_final["fecha"],
-                            "hora": accion_final["hora"],
-                            "cancha_id": accion_final["cancha_id"],
-                            "nombre": accion_final["nombre"],
-                            "telefono": accion_final["telefono"],
-                        }]
-                        sesion["esperando_comprobante"] = True
-                        sesion["esperando_desde"] = ahora_arg().isoformat()
-                        sesion["historial"] = []
-                        sesion_set(wa_id, sesion)
-                        enviar_mensaje_whatsapp(
-                            wa_id,
-                            "Perfecto! Para confirmar tu reserva necesitás abonar una seña de $10.000 "
-                            "por transferencia bancaria a Alejandro Santillan.\n\n"
-                            "Alias: lcpadel.mp\n"
-                            "Cuenta: Mercado Pago\n\n"
-                            "Una vez que hagas la transferencia, mandame la foto del comprobante y confirmo tu reserva.",
-                        )
-                    elif resultado2 == "MULTIPLES_RESERVAS_LISTAS":
-                        cantidad = len(accion_final["reservas"])
-                        monto_total = cantidad * SENA_MONTO
-                        monto_fmt = f"{monto_total:,}".replace(",", ".")
-                        sesion["reserva_pendiente"] = accion_final["reservas"]
-                        sesion["esperando_comprobante"] = True
-                        sesion["esperando_desde"] = ahora_arg().isoformat()
-                        sesion["historial"] = []
-                        sesion_set(wa_id, sesion)
-                        enviar_mensaje_whatsapp(
-                            wa_id,
-                            f"Perfecto! Para confirmar tus {cantidad} reservas necesitás abonar una seña de ${monto_fmt} "
-                            f"({cantidad} x $10.000) por transferencia bancaria a Alejandro Santillan.\n\n"
-                            "Alias: lcpadel.mp\n"
-                            "Cuenta: Mercado Pago\n\n"
-                            f"Podés hacer una sola transferencia de ${monto_fmt} o varias de $10.000 cada una. "
-                            f"Mandame la foto de cada comprobante y confirmo tus reservas.",
+                # Retry: si Mistral no emitió ACCION cuando debería haberlo hecho
+                PALABRAS_CONSULTA = [
+                    "disponib", "grilla",
+                    "mis reservas", "mis turnos", "tengo reserva",
+                ]
+                texto_lower = texto_usuario.lower()
+                es_consulta = any(p in texto_lower for p in PALABRAS_CONSULTA)
+
+                if es_consulta:
+                    logger.warning(f"Mistral no emitió ACCION para consulta de '{texto_usuario}'. Ejecutando retry.")
+                    historial_retry = list(historial)[:-1]  # sin el último mensaje del usuario
+                    historial_retry.append({
+                        "role": "user",
+                        "content": (
+                            texto_usuario +
+                            "\n\n[SISTEMA: Tu respuesta anterior no llamó a ninguna función. "
+                            "Esto es un error. Debés llamar a la función correspondiente ahora mismo, "
+                            "sin texto previo ni frases de transición.]"
                         )
-                    else:
-                        # Para cualquier otro resultado, seguir el flujo normal.
-                        # Se descarta cualquier ACCION que Mistral emita en esta llamada —
-                        # solo queremos texto natural para comunicar el resultado al usuario.
-                        historial.append({"role": "assistant", "content": texto_final})
-                        historial.append({"role": "user", "content": f"<RESULTADO_SISTEMA>{resultado2}</RESULTADO_SISTEMA>"})
-                        texto_final2, accion_descartada = llamar_mistral(historial, hoy, telefono_conocido, nombre_conocido)
-                        if accion_descartada:
-                            logger.warning(f"Mistral emitió ACCION inesperada en llamada de traducción (ignorada): {accion_descartada.get('tipo')}")
-                        historial.append({"role": "assistant", "content": texto_final2})
-                        sesion["historial"] = historial[-20:]
-                        sesion_set(wa_id, sesion)
-                        enviar_mensaje_whatsapp(wa_id, texto_final2)
-                else:
-                    if texto_final and texto_final != ".":  # no enviar ni guardar el placeholder interno
-                        historial.append({"role": "assistant", "content": texto_final})
-                    sesion["historial"] = historial[-20:]
-                    sesion_set(wa_id, sesion)
-                    if texto_final and texto_final != ".":
-                        enviar_mensaje_whatsapp(wa_id, texto_final)
-
-        else:
-            # Retry: si Mistral no emitió ACCION cuando debería haberlo hecho
-            PALABRAS_CONSULTA = [
-                "disponib", "grilla",
-                "mis reservas", "mis turnos", "tengo reserva",
-            ]
-            texto_lower = texto_usuario.lower()
-            es_consulta = any(p in texto_lower for p in PALABRAS_CONSULTA)
-
-            if es_consulta:
-                logger.warning(f"Mistral no emitió ACCION para consulta de '{texto_usuario}'. Ejecutando retry.")
-                historial_retry = historial[:-1]  # sin el último mensaje del usuario
-                historial_retry.append({
-                    "role": "user",
-                    "content": (
-                        texto_usuario +
-                        "\n\n[SISTEMA: Tu respuesta anterior no incluyó el bloque <ACCION>. "
-                        "Esto es un error. Debés emitir la <ACCION> correspondiente ahora mismo, "
-                        "sin texto previo ni frases de transición.]"
+                    })
+                    texto_retry, accion_retry = await llamar_mistral(
+                        historial_retry, hoy, telefono_conocido, nombre_conocido, tool_choice="any"
                     )
-                })
-                texto_retry, accion_retry = llamar_mistral(historial_retry, hoy, telefono_conocido, nombre_conocido)
-
-                if accion_retry:
-                    logger.info(f"Retry exitoso. Accion obtenida: {accion_retry.get('tipo')}")
-                    resultado_retry = ejecutar_accion(accion_retry, sesion.get("telefono_confirmado"))
-                    historial.append({"role": "assistant", "content": texto_retry})
-                    historial.append({"role": "user", "content": f"<RESULTADO_SISTEMA>{resultado_retry}</RESULTADO_SISTEMA>"})
-
-                    # Para consultar_disponibilidad: construir el mensaje directo en código,
-                    # sin pasar por Mistral, para evitar que complete la lista con horarios de memoria.
-                    if accion_retry.get("tipo") == "consultar_disponibilidad":
-                        texto_final = formatear_disponibilidad(resultado_retry, accion_retry)
-                        historial.append({"role": "assistant", "content": texto_final})
-                        sesion["historial"] = historial
-                        sesion_set(wa_id, sesion)
-                        enviar_mensaje_whatsapp(wa_id, texto_final)
-                    else:
-                        texto_final, accion_final = llamar_mistral(historial, hoy, telefono_conocido, nombre_conocido)
-                        # Si Mistral volvió a emitir una ACCION, procesarla en lugar de mandar JSON crudo
-                        if accion_final:
-                            logger.warning(f"Mistral emitió ACCION inesperada en llamada post-retry: {accion_final.get('tipo')}. Reprocesando.")
-                            resultado_final = ejecutar_accion(accion_final, sesion.get("telefono_confirmado"))
-                            if resultado_final == "RESERVA_LISTA":
-                                sesion["reserva_pendiente"] = [{
-                                    "fecha": accion_final["fecha"],
-                                    "hora": accion_final["hora"],
-                                    "cancha_id": accion_final["cancha_id"],
-                                    "nombre": accion_final["nombre"],
-                                    "telefono": accion_final["telefono"],
-                                }]
-                                sesion["esperando_comprobante"] = True
-                                sesion["esperando_desde"] = ahora_arg().isoformat()
-                                sesion["historial"] = []
-                                sesion_set(wa_id, sesion)
-                                enviar_mensaje_whatsapp(
-                                    wa_id,
-                                    "Perfecto! Para confirmar tu reserva necesitás abonar una seña de $10.000 "
-                                    "por transferencia bancaria a Alejandro Santillan.\n\n"
-                                    "Alias: lcpadel.mp\n"
-                                    "Cuenta: Mercado Pago\n\n"
-                                    "Una vez que hagas la transferencia, mandame la foto del comprobante y confirmo tu reserva.",
-                                )
-                            elif resultado_final == "MULTIPLES_RESERVAS_LISTAS":
-                                cantidad = len(accion_final["reservas"])
-                                monto_total = cantidad * SENA_MONTO
-                                monto_fmt = f"{monto_total:,}".replace(",", ".")
-                                sesion["reserva_pendiente"] = accion_final["reservas"]
-                                sesion["esperando_comprobante"] = True
-                                sesion["esperando_desde"] = ahora_arg().isoformat()
-                                sesion["historial"] = []
-                                sesion_set(wa_id, sesion)
-                                enviar_mensaje_whatsapp(
-                                    wa_id,
-                                    f"Perfecto! Para confirmar tus {cantidad} reservas necesitás abonar una seña de ${monto_fmt} "
-                                    f"({cantidad} x $10.000) por transferencia bancaria a Alejandro Santillan.\n\n"
-                                    "Alias: lcpadel.mp\n"
-                                    "Cuenta: Mercado Pago\n\n"
-                                    f"Podés hacer una sola transferencia de ${monto_fmt} o varias de $10.000 cada una. "
-                                    f"Mandame la foto de cada comprobante y confirmo tus reservas.",
-                                )
-                            else:
-                                historial.append({"role": "assistant", "content": texto_final})
-                                sesion["historial"] = historial[-20:]
-                                sesion_set(wa_id, sesion)
-                                enviar_mensaje_whatsapp(wa_id, texto_final)
+
+                    if accion_retry:
+                        logger.info(f"Retry exitoso. Accion obtenida: {accion_retry.get('tipo')}")
+                        resultado_retry = await ejecutar_accion(accion_retry, sesion.get("telefono_confirmado"))
+                        agregar_resultado(historial, texto_retry, resultado_retry)
+
+                        # Para consultar_disponibilidad: construir el mensaje directo en código,
+                        # sin pasar por Mistral, para evitar que complete la lista con horarios de memoria.
+                        if accion_retry.get("tipo") == "consultar_disponibilidad":
+                            cerrar_turno(wa_id, sesion, historial, formatear_disponibilidad(resultado_retry, accion_retry))
                         else:
-                            historial.append({"role": "assistant", "content": texto_final})
-                            sesion["historial"] = historial[-20:]
-                            sesion_set(wa_id, sesion)
-                            enviar_mensaje_whatsapp(wa_id, texto_final)
+                            texto_final, accion_final = await llamar_mistral(historial, hoy, telefono_conocido, nombre_conocido)
+                            # Si Mistral volvió a emitir una ACCION, procesarla en lugar de mandar JSON crudo
+                            if accion_final:
+                                logger.warning(f"Mistral emitió ACCION inesperada en llamada post-retry: {accion_final.get('tipo')}. Reprocesando.")
+                                resultado_final = await ejecutar_accion(accion_final, sesion.get("telefono_confirmado"))
+                                if resultado_final in ("RESERVA_LISTA", "MULTIPLES_RESERVAS_LISTAS"):
+                                    pedir_sena(wa_id, sesion, accion_final, resultado_final)
+                                else:
+                                    cerrar_turno(wa_id, sesion, historial, texto_final)
+                            else:
+                                cerrar_turno(wa_id, sesion, historial, texto_final)
+                    else:
+                        logger.warning(f"Retry fallido. Mistral tampoco emitió ACCION en segundo intento.")
+                        cerrar_turno(wa_id, sesion, historial, texto_respuesta)
                 else:
-                    logger.warning(f"Retry fallido. Mistral tampoco emitió ACCION en segundo intento.")
-                    historial.append({"role": "assistant", "content": texto_respuesta})
-                    sesion["historial"] = historial[-20:]
-                    sesion_set(wa_id, sesion)
-                    enviar_mensaje_whatsapp(wa_id, texto_respuesta)
-            else:
-                historial.append({"role": "assistant", "content": texto_respuesta})
-                sesion["historial"] = historial[-20:]
-                sesion_set(wa_id, sesion)
-                enviar_mensaje_whatsapp(wa_id, texto_respuesta)
+                    cerrar_turno(wa_id, sesion, historial, texto_respuesta)
 
-    except Exception as e:
-        logger.error(f"Error en manejar_mensaje_wa: {traceback.format_exc()}")
-        enviar_mensaje_whatsapp(wa_id, "Hubo un problema tecnico, intenta de nuevo.")
+        except Exception as e:
+            ctx.descartar()
+            logger.error(f"Error en manejar_mensaje_wa: {traceback.format_exc()}")
+            programar_envio_whatsapp(wa_id, "Hubo un problema tecnico, intenta de nuevo.")
 
 
-def manejar_foto_wa(wa_id: str, image_id: str, media_type: str = "image/jpeg"):
-    """Procesa una imagen enviada por el usuario (comprobante de seña)."""
-    sesion = sesion_get(wa_id)
+ACK_COMPROBANTE_SEG = 2.0
 
-    if not sesion["esperando_comprobante"]:
-        enviar_mensaje_whatsapp(
-            wa_id,
-            "No estoy esperando ningún comprobante en este momento. "
-            "Si querés hacer una reserva, escribime los datos.",
-        )
-        return
+# Motivos de verificar_comprobante que indican una falla nuestra y no un rechazo del comprobante
+_ERROR_TECNICO_RE = re.compile(r"error t[eé]cnico|error interno|servicio", re.IGNORECASE)
 
-    reserva_pendiente = sesion["reserva_pendiente"]
-    if not reserva_pendiente:
-        sesion["esperando_comprobante"] = False
-        sesion_set(wa_id, sesion)
-        enviar_mensaje_whatsapp(
-            wa_id,
-            "Hubo un problema con tu reserva pendiente. Por favor empezá de nuevo.",
-        )
-        return
+# Las fotos de WhatsApp llegan de 1-3 MB; para leer el comprobante alcanza con mucho menos.
+MAX_LADO_IMAGEN = 1600
+MIN_BYTES_REDUCIR = 300 * 1024
+
+def reducir_imagen(imagen_bytes: bytes, media_type: str) -> tuple[bytes, str]:
+    """
+    Achica la imagen a MAX_LADO_IMAGEN px de lado y la recomprime como JPEG q80.
+    Las imágenes chicas y los documentos que no son imagen (p. ej. PDF) se devuelven tal cual.
+    """
+    if not media_type.startswith("image/") or len(imagen_bytes) < MIN_BYTES_REDUCIR:
+        return imagen_bytes, media_type
+    try:
+        img = ImageOps.exif_transpose(Image.open(BytesIO(imagen_bytes)))
+        img.thumbnail((MAX_LADO_IMAGEN, MAX_LADO_IMAGEN))
+        buf = BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=80, optimize=True)
+    except Exception as e:
+        logger.warning(f"No se pudo reducir la imagen, se manda la original: {e}")
+        return imagen_bytes, media_type
+    reducida = buf.getvalue()
+    if len(reducida) >= len(imagen_bytes):
+        return imagen_bytes, media_type
+    return reducida, "image/jpeg"
+
+# Veredictos negativos (inválido o ilegible) por contenido de la imagen. Si el usuario reenvía
+# la misma foto, se contesta lo mismo sin volver a llamar a Gemini. Los válidos no se guardan:
+# el reenvío de un comprobante válido lo resuelve la BD (DUPLICADO); tampoco los errores técnicos.
+_VERIFICACION_TTL_SEG = 3600
+_verificaciones: dict[tuple, tuple[float, dict]] = {}
+_MAX_VERIFICACIONES = 500
+
+async def descargar_y_verificar(image_id: str, media_type: str, cantidad_pendiente: int):
+    """
+    Descarga la imagen y la verifica contra el total de señas pendientes y, si hay más de
+    una reserva, también contra una sola seña (pago parcial), en una sola llamada.
+    Retorna (resultado, monto_este_comprobante), o None si no se pudo descargar.
+    """
+    imagen_bytes = await descargar_imagen_whatsapp(image_id)
+    if not imagen_bytes:
+        return None
 
-    # Normalizar siempre a lista
-    if isinstance(reserva_pendiente, dict):
-        reserva_pendiente = [reserva_pendiente]
+    # Con más de una reserva se acepta el total o una sola seña (pago parcial), en una sola llamada
+    montos = (cantidad_pendiente * SENA_MONTO, SENA_MONTO) if cantidad_pendiente > 1 else (SENA_MONTO,)
+    clave = (hashlib.blake2b(imagen_bytes, digest_size=16).digest(), montos, hoy_argentina())
+    cacheada = _verificaciones.get(clave)
+    if cacheada and time.monotonic() - cacheada[0] < _VERIFICACION_TTL_SEG:
+        logger.info("Comprobante ya verificado (misma imagen), se reutiliza el resultado.")
+        return cacheada[1], SENA_MONTO
 
-    reservas_pendientes = reserva_pendiente
-    cantidad_pendiente = len(reservas_pendientes)
-    monto_este_comprobante = SENA_MONTO
-    monto_total_restante = cantidad_pendiente * SENA_MONTO
+    # Pillow es CPU-bound: fuera del event loop
+    imagen_bytes, media_type = await asyncio.to_thread(reducir_imagen, imagen_bytes, media_type)
+    resultado = await verificar_comprobante(imagen_bytes, media_type, montos)
 
-    enviar_mensaje_whatsapp(wa_id, "Recibí el comprobante, lo estoy verificando...")
+    if not resultado.get("valido") and not _ERROR_TECNICO_RE.search(resultado.get("motivo") or ""):
+        if len(_verificaciones) >= _MAX_VERIFICACIONES:
+            _verificaciones.clear()
+        _verificaciones[clave] = (time.monotonic(), resultado)
 
-    try:
-        imagen_bytes = descargar_imagen_whatsapp(image_id)
-        if not imagen_bytes:
-            enviar_mensaje_whatsapp(
+    # Si es válido pero no queda claro cuál monto coincidió, se toma como una sola seña
+    return resultado, resultado.get("monto") or SENA_MONTO
+
+async def manejar_foto_wa(wa_id: str, image_id: str, media_type: str = "image/jpeg"):
+    """Procesa una imagen enviada por el usuario (comprobante de seña)."""
+    async with SesionCtx(wa_id) as ctx:
+        sesion = ctx.sesion
+
+        if not sesion["esperando_comprobante"]:
+            programar_envio_whatsapp(
                 wa_id,
-                "No pude descargar la imagen. Por favor intentá mandarla de nuevo.",
+                "No estoy esperando ningún comprobante en este momento. "
+                "Si querés hacer una reserva, escribime los datos.",
             )
             return
 
-        # Verificar contra monto total restante
-        resultado = verificar_comprobante(imagen_bytes, media_type, monto_total_restante)
+        reserva_pendiente = sesion["reserva_pendiente"]
+        if not reserva_pendiente:
+            sesion["esperando_comprobante"] = False
+            programar_envio_whatsapp(
+                wa_id,
+                "Hubo un problema con tu reserva pendiente. Por favor empezá de nuevo.",
+            )
+            return
 
-        # Si no es válido con el total y hay más de 1 reserva, intentar con $10.000 parcial
-        if not resultado.get("valido") and not resultado.get("ilegible") and cantidad_pendiente > 1:
-            resultado_parcial = verificar_comprobante(imagen_bytes, media_type, SENA_MONTO)
-            if resultado_parcial.get("valido"):
-                resultado = resultado_parcial
-                monto_este_comprobante = SENA_MONTO
+        # Normalizar siempre a lista
+        if isinstance(reserva_pendiente, dict):
+            reserva_pendiente = [reserva_pendiente]
 
-        logger.info(f"Verificación comprobante wa_id={wa_id}: {resultado}")
+        reservas_pendientes = reserva_pendiente
+        cantidad_pendiente = len(reservas_pendientes)
+        monto_total_restante = cantidad_pendiente * SENA_MONTO
 
-        if resultado.get("ilegible"):
-            enviar_mensaje_whatsapp(
-                wa_id,
-                "No pude leer bien la imagen, está borrosa o cortada. "
-                "Por favor mandá otra foto más clara del comprobante.",
+        try:
+            # Si la verificación es rápida, el usuario recibe directamente el resultado;
+            # el aviso "lo estoy verificando" solo sale si tarda más de ACK_COMPROBANTE_SEG.
+            verificacion = asyncio.create_task(
+                descargar_y_verificar(image_id, media_type, cantidad_pendiente)
             )
-            return
+            try:
+                verificado = await asyncio.wait_for(asyncio.shield(verificacion), ACK_COMPROBANTE_SEG)
+            except asyncio.TimeoutError:
+                programar_envio_whatsapp(wa_id, "Recibí el comprobante, lo estoy verificando...")
+                verificado = await verificacion
 
-        if resultado.get("valido"):
-            numero_operacion = resultado.get("numero_operacion")
+            if verificado is None:
+                programar_envio_whatsapp(
+                    wa_id,
+                    "No pude descargar la imagen. Por favor intentá mandarla de nuevo.",
+                )
+                return
+            resultado, monto_este_comprobante = verificado
 
-            if numero_operacion and operacion_ya_usada(numero_operacion):
-                enviar_mensaje_whatsapp(
+            logger.info(f"Verificación comprobante wa_id={wa_id}: {resultado}")
+
+            if resultado.get("ilegible"):
+                programar_envio_whatsapp(
                     wa_id,
-                    "Este comprobante ya fue utilizado para otra reserva. "
-                    "Por favor realizá una nueva transferencia y mandá el comprobante nuevo.",
+                    "No pude leer bien la imagen, está borrosa o cortada. "
+                    "Por favor mandá otra foto más clara del comprobante.",
                 )
                 return
 
-            if monto_este_comprobante >= monto_total_restante or cantidad_pendiente == 1:
-                # Confirmar todas las reservas pendientes
-                reservas_creadas = []
-                hubo_duplicado = False
-                for r in reservas_pendientes:
-                    reserva = crear_reserva(
-                        r["fecha"], r["hora"], r["cancha_id"],
-                        r["nombre"], r["telefono"], numero_operacion,
-                    )
-                    if reserva == "DUPLICADO":
-                        hubo_duplicado = True
-                    elif reserva:
-                        reservas_creadas.append(reserva)
-
-                if hubo_duplicado:
-                    # No resetear sesión — el usuario puede mandar otro comprobante
-                    enviar_mensaje_whatsapp(
-                        wa_id,
-                        "Este comprobante ya fue utilizado para una reserva anterior y no puede reutilizarse.\n\n"
-                        "Por favor realizá una nueva transferencia a Alejandro Santillan y mandame el comprobante nuevo.",
-                    )
-                elif reservas_creadas:
-                    sesion["esperando_comprobante"] = False
-                    sesion["reserva_pendiente"] = None
-                    sesion["telefono_confirmado"] = reservas_pendientes[0]["telefono"]
-                    sesion["historial"] = []
-                    sesion_set(wa_id, sesion)
-                    if len(reservas_creadas) == 1:
-                        r_data = reservas_creadas[0]
-                        enviar_mensaje_whatsapp(
+            if resultado.get("valido"):
+                numero_operacion = resultado.get("numero_operacion")
+                # El comprobante reutilizado lo detecta la BD al insertar (DUPLICADO)
+
+                if monto_este_comprobante >= monto_total_restante or cantidad_pendiente == 1:
+                    # Confirmar todas las reservas pendientes en un solo INSERT
+                    reservas_creadas = await crear_reservas(reservas_pendientes, numero_operacion)
+
+                    if reservas_creadas == "DUPLICADO":
+                        # No resetear sesión — el usuario puede mandar otro comprobante
+                        programar_envio_whatsapp(
                             wa_id,
-                            f"Comprobante verificado correctamente.\n\n"
-                            f"Tu reserva quedo confirmada:\n"
-                            f"ID: #{r_data['id']}\n"
-                            f"Fecha: {r_data['fecha']}\n"
-                            f"Hora: {r_data['hora']}\n"
-                            f"Cancha: {CANCHAS[r_data['cancha_id']]}\n"
-                            f"Nombre: {r_data['nombre_cliente']}\n\n"
-                            f"Nos vemos en la cancha!",
+                            "Este comprobante ya fue utilizado para una reserva anterior y no puede reutilizarse.\n\n"
+                            "Por favor realizá una nueva transferencia a Alejandro Santillan y mandame el comprobante nuevo.",
                         )
+                    elif reservas_creadas:
+                        sesion["esperando_comprobante"] = False
+                        sesion["reserva_pendiente"] = None
+                        sesion["telefono_confirmado"] = reservas_pendientes[0]["telefono"]
+                        sesion["historial"] = []
+                        if len(reservas_creadas) == 1:
+                            r_data = reservas_creadas[0]
+                            programar_envio_whatsapp(
+                                wa_id,
+                                f"Comprobante verificado correctamente.\n\n"
+                                f"Tu reserva quedo confirmada:\n"
+                                f"ID: #{r_data['id']}\n"
+                                f"Fecha: {r_data['fecha']}\n"
+                                f"Hora: {r_data['hora']}\n"
+                                f"Cancha: {NOMBRE_CANCHA[r_data['cancha_id']]}\n"
+                                f"Nombre: {r_data['nombre_cliente']}\n\n"
+                                f"Nos vemos en la cancha!",
+                            )
+                        else:
+                            lineas = "\n".join(
+                                f"#{r['id']} - {r['fecha']} {r['hora']} - {NOMBRE_CANCHA[r['cancha_id']]}"
+                                for r in reservas_creadas
+                            )
+                            programar_envio_whatsapp(
+                                wa_id,
+                                f"Comprobante verificado correctamente.\n\n"
+                                f"Tus {len(reservas_creadas)} reservas quedaron confirmadas:\n"
+                                f"{lineas}\n\n"
+                                f"Nos vemos en la cancha!",
+                            )
                     else:
-                        lineas = "\n".join(
-                            f"#{r['id']} - {r['fecha']} {r['hora']} - {CANCHAS[r['cancha_id']]}"
-                            for r in reservas_creadas
-                        )
-                        enviar_mensaje_whatsapp(
+                        # Error técnico — no resetear sesión, el usuario puede reintentar
+                        programar_envio_whatsapp(
                             wa_id,
-                            f"Comprobante verificado correctamente.\n\n"
-                            f"Tus {len(reservas_creadas)} reservas quedaron confirmadas:\n"
-                            f"{lineas}\n\n"
-                            f"Nos vemos en la cancha!",
+                            "Hubo un problema técnico al guardar tu reserva. "
+                            "Por favor intentá mandar el comprobante de nuevo o contactá al club directamente.",
                         )
                 else:
-                    # Error técnico — no resetear sesión, el usuario puede reintentar
-                    enviar_mensaje_whatsapp(
-                        wa_id,
-                        "Hubo un problema técnico al guardar tu reserva. "
-                        "Por favor intentá mandar el comprobante de nuevo o contactá al club directamente.",
-                    )
-            else:
-                # Pago parcial: confirmar solo la primera reserva de la lista
-                r = reservas_pendientes[0]
-                reserva = crear_reserva(
-                    r["fecha"], r["hora"], r["cancha_id"],
-                    r["nombre"], r["telefono"], numero_operacion,
-                )
+                    # Pago parcial: confirmar solo la primera reserva de la lista
+                    r = reservas_pendientes[0]
+                    creadas = await crear_reservas([r], numero_operacion)
+                    if creadas == "DUPLICADO":
+                        # No tocar la sesión — el usuario puede mandar otro comprobante
+                        programar_envio_whatsapp(
+                            wa_id,
+                            "Este comprobante ya fue utilizado para otra reserva. "
+                            "Por favor realizá una nueva transferencia y mandá el comprobante nuevo.",
+                        )
+                        return
+                    reserva = creadas[0] if creadas else None
 
-                restantes = reservas_pendientes[1:]
-                sesion["reserva_pendiente"] = restantes
-                if reserva and reserva != "DUPLICADO":
-                    sesion["telefono_confirmado"] = r["telefono"]
-                sesion["historial"] = []
-                sesion_set(wa_id, sesion)
+                    restantes = reservas_pendientes[1:]
+                    sesion["reserva_pendiente"] = restantes
+                    if reserva:
+                        sesion["telefono_confirmado"] = r["telefono"]
+                    sesion["historial"] = []
 
-                cantidad_restante = len(restantes)
-                monto_restante = cantidad_restante * SENA_MONTO
-                monto_restante_fmt = f"{monto_restante:,}".replace(",", ".")
+                    cantidad_restante = len(restantes)
+                    monto_restante_fmt = monto_senas_fmt(cantidad_restante)
 
-                if reserva and reserva != "DUPLICADO":
-                    enviar_mensaje_whatsapp(
+                    if reserva:
+                        programar_envio_whatsapp(
+                            wa_id,
+                            f"Comprobante verificado. Reserva confirmada:\n"
+                            f"ID: #{reserva['id']} - {r['fecha']} {r['hora']} - {NOMBRE_CANCHA[r['cancha_id']]}\n\n"
+                            f"Todavía te falta abonar la seña de {cantidad_restante} reserva"
+                            f"{'s' if cantidad_restante > 1 else ''} más "
+                            f"(${monto_restante_fmt}). Mandame el próximo comprobante.",
+                        )
+                    else:
+                        programar_envio_whatsapp(
+                            wa_id,
+                            "El comprobante es válido pero hubo un problema técnico al guardar la reserva. "
+                            "Por favor contactá al club directamente.",
+                        )
+            else:
+                motivo = resultado.get("motivo", "No cumple los requisitos")
+                monto_fmt = monto_senas_fmt(cantidad_pendiente)
+                # Distinguir error técnico de rechazo real por criterios
+                if _ERROR_TECNICO_RE.search(motivo):
+                    programar_envio_whatsapp(
                         wa_id,
-                        f"Comprobante verificado. Reserva confirmada:\n"
-                        f"ID: #{reserva['id']} - {r['fecha']} {r['hora']} - {CANCHAS[r['cancha_id']]}\n\n"
-                        f"Todavía te falta abonar la seña de {cantidad_restante} reserva"
-                        f"{'s' if cantidad_restante > 1 else ''} más "
-                        f"(${monto_restante_fmt}). Mandame el próximo comprobante.",
+                        "Hubo un problema técnico al verificar el comprobante. "
+                        "Por favor mandalo de nuevo en unos segundos.",
                     )
                 else:
-                    enviar_mensaje_whatsapp(
+                    programar_envio_whatsapp(
                         wa_id,
-                        "El comprobante es válido pero hubo un problema técnico al guardar la reserva. "
-                        "Por favor contactá al club directamente.",
+                        f"El comprobante no es válido: {motivo}\n\n"
+                        f"Recordá que la seña debe ser de ${monto_fmt} por transferencia bancaria a Alejandro Santillan. "
+                        f"Mandame otra foto cuando lo tengas.",
                     )
-        else:
-            motivo = resultado.get("motivo", "No cumple los requisitos")
-            monto_fmt = f"{monto_total_restante:,}".replace(",", ".")
-            # Distinguir error técnico de rechazo real por criterios
-            if "error técnico" in motivo.lower() or "error interno" in motivo.lower() or "servicio" in motivo.lower():
-                enviar_mensaje_whatsapp(
-                    wa_id,
-                    "Hubo un problema técnico al verificar el comprobante. "
-                    "Por favor mandalo de nuevo en unos segundos.",
-                )
-            else:
-                enviar_mensaje_whatsapp(
-                    wa_id,
-                    f"El comprobante no es válido: {motivo}\n\n"
-                    f"Recordá que la seña debe ser de ${monto_fmt} por transferencia bancaria a Alejandro Santillan. "
-                    f"Mandame otra foto cuando lo tengas.",
-                )
 
-    except Exception as e:
-        logger.error(f"Error procesando foto wa_id={wa_id}: {traceback.format_exc()}")
-        enviar_mensaje_whatsapp(
-            wa_id,
-            "Hubo un problema técnico al procesar la imagen. Intentá mandar la foto de nuevo.",
-        )
+        except Exception as e:
+            ctx.descartar()
+            logger.error(f"Error procesando foto wa_id={wa_id}: {traceback.format_exc()}")
+            programar_envio_whatsapp(
+                wa_id,
+                "Hubo un problema técnico al procesar la imagen. Intentá mandar la foto de nuevo.",
+            )
 
 # ── FastAPI Webhook ───────────────────────────
 
+async def _precalentar(nombre: str, coro):
+    try:
+        await asyncio.wait_for(coro, timeout=10)
+        logger.info(f"Conexión precalentada: {nombre}")
+    except Exception as e:
+        logger.warning(f"No se pudo precalentar {nombre}: {e}")
+
+# Procesamiento de mensajes en segundo plano: el webhook encola y responde 200 a Meta
+# enseguida (si tarda, Meta reintenta y duplica). Una sola cola acotada alimenta a
+# N_WORKERS workers; si llega un mensaje de un usuario que ya tiene un turno en curso,
+# el worker lo deja en la fila de ese usuario y sigue con otro. Así cada usuario se
+# procesa de a uno y en orden, sin que un turno lento frene a los demás.
+N_WORKERS = int(os.environ.get("N_WORKERS", "8"))
+MAX_COLA_MENSAJES = 500
+# Tope por mensaje: alcanza para los reintentos LLM, pero una llamada colgada no puede
+# frenar para siempre al usuario (sus mensajes van en fila), a un worker ni al apagado.
+TIMEOUT_TURNO_SEG = 120
+_cola_mensajes: asyncio.Queue = asyncio.Queue(maxsize=MAX_COLA_MENSAJES)
+# wa_id -> mensajes de ese usuario que esperan a que termine su turno actual
+_en_curso: dict[str, deque] = {}
+
+async def encolar_mensaje(wa_id: str, handler, *args):
+    await _cola_mensajes.put((wa_id, handler, args))
+
+async def _procesar_mensaje(wa_id: str, handler, args: tuple):
+    try:
+        await asyncio.wait_for(handler(*args), timeout=TIMEOUT_TURNO_SEG)
+    except asyncio.TimeoutError:
+        # SesionCtx no guarda la sesión de un turno cancelado
+        logger.error(f"Timeout procesando mensaje de {wa_id} ({TIMEOUT_TURNO_SEG}s)")
+        programar_envio_whatsapp(wa_id, "Hubo un problema tecnico, intenta de nuevo.")
+    except Exception:
+        logger.error(f"Error procesando mensaje de {wa_id}: {traceback.format_exc()}")
+    finally:
+        _cola_mensajes.task_done()
+
+async def _worker_mensajes():
+    while True:
+        wa_id, handler, args = await _cola_mensajes.get()
+        pendientes = _en_curso.get(wa_id)
+        if pendientes is not None:
+            # Otro worker está con este usuario: que lo procese él al terminar
+            pendientes.append((handler, args))
+            continue
+        pendientes = _en_curso[wa_id] = deque()
+        try:
+            await _procesar_mensaje(wa_id, handler, args)
+            while pendientes:
+                handler, args = pendientes.popleft()
+                await _procesar_mensaje(wa_id, handler, args)
+        finally:
+            del _en_curso[wa_id]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Abrir TCP + TLS con cada servicio antes del primer webhook, para que el primer
+    # mensaje de un usuario no pague DNS y handshakes en el camino crítico.
+    # Gemini no se precalienta: google-genai 1.2.0 abre una requests.Session nueva por
+    # llamada, así que no queda ninguna conexión para reutilizar.
+    await asyncio.gather(
+        _precalentar("supabase", ejecutar_bd(
+            supabase.table("sesiones_bot").select("telegram_user_id").limit(1)
+        )),
+        _precalentar("whatsapp", WA_CLIENT.get(f"{GRAPH_BASE}/{WHATSAPP_PHONE_NUMBER_ID}")),
+        _precalentar("mistral", mistral.models.list_async()),
+    )
+    workers = [asyncio.create_task(_worker_mensajes()) for _ in range(N_WORKERS)]
+    yield
+    # Terminar lo que ya estaba encolado antes de cerrar los clientes
+    await _cola_mensajes.join()
+    for w in workers:
+        w.cancel()
+    if _envios_pendientes:
+        await asyncio.gather(*_envios_pendientes, return_exceptions=True)
+    await WA_CLIENT.aclose()
+    SUPABASE_HTTP.close()
+
+app = FastAPI(lifespan=lifespan)
+
 @app.get("/webhook")
 async def webhook_verificar(
     hub_mode: str = Query(None, alias="hub.mode"),
@@ -1324,10 +1817,10 @@ async def webhook_verificar(
 
 
 @app.post("/webhook")
-async def webhook_recibir(request: Request):
+async def webhook_recibir(request: Request) -> dict[str, str]:
     """Procesa mensajes entrantes de WhatsApp."""
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
     except Exception:
         raise HTTPException(status_code=400, detail="JSON inválido")
 
@@ -1349,21 +1842,21 @@ async def webhook_recibir(request: Request):
                     if msg_type == "text":
                         texto = msg.get("text", {}).get("body", "").strip()
                         if texto:
-                            manejar_mensaje_wa(wa_id, texto)
+                            await encolar_mensaje(wa_id, manejar_mensaje_wa, wa_id, texto)
 
                     elif msg_type == "image":
                         image_info = msg.get("image", {})
                         image_id = image_info.get("id")
                         mime_type = image_info.get("mime_type", "image/jpeg")
                         if image_id:
-                            manejar_foto_wa(wa_id, image_id, mime_type)
+                            await encolar_mensaje(wa_id, manejar_foto_wa, wa_id, image_id, mime_type)
 
                     elif msg_type == "document":
                         doc_info = msg.get("document", {})
                         doc_id = doc_info.get("id")
                         mime_type = doc_info.get("mime_type", "image/jpeg")
                         if doc_id:
-                            manejar_foto_wa(wa_id, doc_id, mime_type)
+                            await encolar_mensaje(wa_id, manejar_foto_wa, wa_id, doc_id, mime_type)
 
                     else:
                         logger.info(f"Tipo de mensaje no soportado: {msg_type} | wa_id={wa_id}")
@@ -1377,4 +1870,6 @@ async def webhook_recibir(request: Request):
 # ── Main ──────────────────────────────────────
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=10000)
+    # Un solo proceso: la deduplicación de mensajes, las colas por usuario y los cachés
+    # viven en memoria, así que varios workers procesarían mensajes en paralelo sin verse.
+    uvicorn.run(app, host="0.0.0.0", port=10000, loop="uvloop", http="httptools")
@@ -0,0 +1,28 @@
+-- Lee la sesión de un usuario y, si la espera del comprobante expiró, la resetea
+-- en la misma sentencia. Reemplaza el read-check-write que hacía el bot con dos
+-- round-trips (SELECT + UPSERT) y que podía pisarse con mensajes concurrentes.
+create or replace function get_or_expire_session(wa text, timeout_min int)
+returns setof sesiones_bot
+language plpgsql
+as $$
+begin
+  return query
+    with expirada as (
+      update sesiones_bot
+         set esperando_comprobante = false,
+             reserva_pendiente = null,
+             esperando_desde = null,
+             actualizado_en = now()
+       where telegram_user_id = wa
+         and esperando_comprobante
+         and esperando_desde is not null
+         and esperando_desde::timestamptz < now() - make_interval(mins => timeout_min)
+      returning *
+    )
+    select * from expirada;
+
+  if not found then
+    return query select * from sesiones_bot where telegram_user_id = wa;
+  end if;
+end;
+$$;
@@ -0,0 +1,28 @@
+-- Un número de operación solo puede respaldar reservas activas de un mismo lote.
+-- Las filas de un mismo comprobante (varias reservas pagadas con una transferencia)
+-- comparten lote_id; cualquier otra fila activa con el mismo número viola la
+-- restricción (SQLSTATE 23P01) y el bot la trata como comprobante reutilizado.
+-- Reemplaza el SELECT previo que hacía operacion_ya_usada antes de cada INSERT.
+create extension if not exists btree_gist;
+
+alter table reservas add column if not exists lote_id uuid;
+
+-- Backfill: antes cada fila de un mismo comprobante se insertaba por separado y
+-- ninguna columna las agrupaba. Como operacion_ya_usada impedía reutilizar un número,
+-- las filas activas que comparten numero_operacion son un mismo lote.
+update reservas r
+   set lote_id = g.lote_id
+  from (
+    select numero_operacion, gen_random_uuid() as lote_id
+      from reservas
+     where estado <> 'cancelada' and numero_operacion is not null
+     group by numero_operacion
+  ) g
+ where r.numero_operacion = g.numero_operacion
+   and r.estado <> 'cancelada'
+   and r.lote_id is null;
+
+alter table reservas
+  add constraint reservas_numero_operacion_excl
+  exclude using gist (numero_operacion with =, lote_id with <>)
+  where (estado <> 'cancelada' and numero_operacion is not null);
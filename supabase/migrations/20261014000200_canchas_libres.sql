@@ -0,0 +1,32 @@
+-- Canchas libres para uno o varios turnos en una sola llamada: el turno i es
+-- (p_fechas[i], p_horas[i]) y se devuelve con orden = i. Aplica la misma regla que
+-- hay_solapamiento en el bot: dos turnos de p_duracion minutos se pisan si
+-- inicio_A < fin_B y inicio_B < fin_A. Devuelve solo los ids de cancha en lugar
+-- de todas las reservas del día.
+create or replace function canchas_libres(
+  p_fechas date[],
+  p_horas text[],
+  p_canchas int[],
+  p_duracion int default 90
+)
+returns table (orden bigint, libres int[])
+language sql
+stable
+as $$
+  select t.orden,
+         array(
+           select c
+             from unnest(p_canchas) as c
+            where not exists (
+              select 1
+                from reservas r
+               where r.fecha = t.fecha
+                 and r.cancha_id = c
+                 and r.estado is distinct from 'cancelada'
+                 and extract(epoch from r.hora::time) / 60 < extract(epoch from t.hora::time) / 60 + p_duracion
+                 and extract(epoch from t.hora::time) / 60 < extract(epoch from r.hora::time) / 60 + p_duracion
+            )
+            order by c
+         )
+    from unnest(p_fechas, p_horas) with ordinality as t(fecha, hora, orden);
+$$;